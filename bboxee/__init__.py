@@ -24,5 +24,14 @@
 # --------------------------------------------------------------------------
 __version__ = '1.1.0'
 
-from bboxee import gui  # noqa: F401
-from .exception_handler import ExceptionHandler  # noqa: F401
+
+def __getattr__(name):
+    # Qt and the gui are only imported on first use, so the image decoding
+    # processes of bboxee.annotator.pipeline can import the package cheaply
+    if name == 'gui':
+        import importlib
+        return importlib.import_module('bboxee.gui')
+    if name == 'ExceptionHandler':
+        from .exception_handler import ExceptionHandler
+        return ExceptionHandler
+    raise AttributeError("module 'bboxee' has no attribute '{}'".format(name))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import os
+import numpy as np
+from PIL import Image
+from bboxee.annotator.pipeline import prefetch
+from bboxee.annotator.prescreen import thumbnail
+
+
+def dhash(small, hash_size=8):
+    """Difference hash of a grayscale image, one bit per horizontal
+    gradient of a hash_size x hash_size grid, returned as an int."""
+    grid = np.asarray(Image.fromarray(small).resize((hash_size + 1, hash_size), Image.BILINEAR))
+    bits = (grid[:, 1:] > grid[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def distance(a, b):
+    """Number of differing bits between two hashes."""
+    return bin(a ^ b).count('1')
+
+
+class Deduplicator:
+    """Groups near duplicate frames so only one frame of a group is passed
+    to the detector and its detections are propagated to the others.
+
+    A frame joins the group of an earlier representative when it was taken
+    less than window seconds after it and their difference hashes differ by
+    at most threshold bits, otherwise it starts a new group.
+    """
+
+    def __init__(self, window=10.0, threshold=6, hash_size=8, width=160):
+        """Class init function."""
+        self.window = window
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.width = width
+        self.followers = {}
+        self.representatives = set()
+        self.results = {}
+        self.hashed = 0
+
+    def group(self, directory, queue, mask=None):
+        """Group the (count, image_name) items of queue, returns a dict of
+        follower name to the name of its representative. Representatives
+        always come before their followers in queue order."""
+        self.followers = {}
+        self.results = {}
+        self.hashed = 0
+        files = [os.path.join(directory, image_name) for _, image_name in queue]
+        keep = None
+        active = []
+        for (_, image_name), (_, result) in zip(queue, prefetch(lambda f: thumbnail(f, self.width), files)):
+            if result is None:
+                continue
+            taken, small = result
+            if mask is not None:
+                if keep is None or keep.shape != small.shape:
+                    height, width = small.shape
+                    keep = np.asarray(Image.fromarray(mask).resize((width, height), Image.NEAREST)) > 0
+                small = small * keep
+            code = dhash(small, self.hash_size)
+            self.hashed += 1
+            active = [item for item in active if abs(taken - item[1]) <= self.window]
+            match = next((name for name, _, other in active if distance(code, other) <= self.threshold), None)
+            if match is None:
+                active.append((image_name, taken, code))
+            else:
+                self.followers[image_name] = match
+        self.representatives = set(self.followers.values())
+        return dict(self.followers)
+
+    def record(self, image_name, detections):
+        """Keep the detections of a representative for its followers."""
+        if image_name in self.representatives:
+            self.results[image_name] = detections
+
+    def detections(self, image_name):
+        """Detections to propagate to a follower."""
+        return self.results.get(self.followers[image_name], [])
+
+    def summary(self):
+        """Report how many frames were propagated instead of detected."""
+        return 'Dedup: {} of {} frames propagated from {} representatives ({:.1%})'.format(
+            len(self.followers), self.hashed, len(self.representatives), len(self.followers) / max(1, self.hashed))
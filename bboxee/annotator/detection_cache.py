@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import threading
+from bboxee.annotator.registry import registry
+
+
+def cache_directory():
+    """Per user cache directory for BBoxEE."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser(os.path.join('~', 'Library', 'Caches'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache')))
+    return os.path.join(base, 'bboxee')
+
+
+def model_fingerprint(path):
+    """Fingerprint a model file or directory from its path, size and
+    modification time."""
+    _, path, mtime, size, _ = registry.key('', path, '')
+    return hashlib.sha1('{}|{}|{}'.format(path, mtime, size).encode('utf-8')).hexdigest()
+
+
+class DetectionCache:
+    """SQLite cache of raw detections keyed by image, model and input size.
+
+    Images are identified by their path, size and modification time. Raw
+    detections are stored down to the confidence floor they were produced
+    with and are only served for thresholds at or above that floor. The
+    least recently used rows are trimmed once there are more than
+    max_entries. Stored detections are committed every commit_every images,
+    so a crashed run only loses the last few.
+    """
+
+    def __init__(self, path=None, max_entries=500000, commit_every=50):
+        """Class init function."""
+        if path is None:
+            os.makedirs(cache_directory(), exist_ok=True)
+            path = os.path.join(cache_directory(), 'detections.sqlite')
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_every = max(1, commit_every)
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Created on the gui thread and used from the annotator thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS detections '
+                                '(image TEXT, model TEXT, input TEXT, size INTEGER, mtime REAL, '
+                                'floor REAL, detections TEXT, used REAL, PRIMARY KEY (image, model, input))')
+        self.connection.commit()
+
+    def lookup(self, files, model, input_key, threshold):
+        """Return a dictionary of file name to raw detections for every file
+        with a valid entry usable at threshold."""
+        found = {}
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.cursor()
+            for file_name in files:
+                row = None
+                if os.path.exists(file_name):
+                    stat = os.stat(file_name)
+                    cursor.execute('SELECT size, mtime, floor, detections FROM detections '
+                                   'WHERE image = ? AND model = ? AND input = ?',
+                                   (os.path.abspath(file_name), model, input_key))
+                    row = cursor.fetchone()
+                if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime and row[2] <= threshold:
+                    found[file_name] = json.loads(row[3])
+                    cursor.execute('UPDATE detections SET used = ? WHERE image = ? AND model = ? AND input = ?',
+                                   (now, os.path.abspath(file_name), model, input_key))
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            self.connection.commit()
+        return found
+
+    def store(self, file_name, model, input_key, floor, detections):
+        """Save the raw detections of an image, replacing any stale entry."""
+        stat = os.stat(file_name)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (os.path.abspath(file_name), model, input_key, stat.st_size, stat.st_mtime,
+                                     floor, json.dumps(detections), time.time()))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def flush(self):
+        """Commit pending writes and trim the cache to max_entries."""
+        with self.lock:
+            self.connection.execute('DELETE FROM detections WHERE rowid IN '
+                                    '(SELECT rowid FROM detections ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                                    (self.max_entries,))
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def clear(self, model=None):
+        """Invalidate every entry, or only those produced by model."""
+        with self.lock:
+            if model is None:
+                cursor = self.connection.execute('DELETE FROM detections')
+            else:
+                cursor = self.connection.execute('DELETE FROM detections WHERE model = ?', (model,))
+            self.connection.commit()
+            removed = cursor.rowcount
+            self.connection.execute('VACUUM')
+        return removed
+
+    def summary(self):
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM detections').fetchone()[0]
+        size = os.path.getsize(self.path) / 1024 ** 2
+        return 'Detection cache: {} entries, {:0.1f} MB, {} hits, {} misses'.format(entries, size, self.hits, self.misses)
+
+
+_shared = None
+
+
+def shared_cache():
+    """Return the cache shared by all annotators in this process."""
+    global _shared
+    if _shared is None:
+        _shared = DetectionCache()
+    return _shared
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or invalidate the BBoxEE detection cache.')
+    parser.add_argument('--clear', action='store_true', help='remove cached detections')
+    parser.add_argument('--model', help='only remove detections produced by this model file or directory')
+    parser.add_argument('--clear-models', action='store_true', help='remove prepared YOLOv5 models')
+    args = parser.parse_args()
+    if args.clear_models:
+        shutil.rmtree(os.path.join(cache_directory(), 'models'), ignore_errors=True)
+    cache = DetectionCache()
+    if args.clear:
+        model = None if args.model is None else model_fingerprint(args.model)
+        print('Removed {} entries'.format(cache.clear(model)))
+    print(cache.summary())
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import numpy as np
+from bboxee import schema
+
+
+MACHINE = ('machine', 'propagated')
+
+
+def build_entry(detections, threshold, created_by='machine'):
+    """Build an annotation file entry from raw detections above threshold.
+
+    Raw detections are [xmin, ymin, xmax, ymax, confidence, label] lists
+    with coordinates normalized to the image size. Detections copied from a
+    near duplicate frame are created_by 'propagated'.
+    """
+    entry = schema.annotation_file_entry()
+    for x_min, y_min, x_max, y_max, confidence, label in detections:
+        if confidence >= threshold:
+            annotation = schema.annotation()
+            annotation['created_by'] = created_by
+            annotation['confidence'] = confidence
+            annotation['bbox']['xmin'] = x_min
+            annotation['bbox']['xmax'] = x_max
+            annotation['bbox']['ymin'] = y_min
+            annotation['bbox']['ymax'] = y_max
+            annotation['label'] = label
+            entry['annotations'].append(annotation)
+    return entry
+
+
+def iou(a, b):
+    """Intersection over union of two (xmin, ymin, xmax, ymax) boxes."""
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def refilter_entry(entry, detections, threshold, overlap=0.5, created_by='machine', deleted=()):
+    """Replace the machine boxes of an entry with detections above threshold.
+
+    Boxes a human created or edited are kept, and detections overlapping
+    them are dropped so an edited box is not duplicated. Detections
+    overlapping a deleted machine box are dropped so the box stays deleted.
+    """
+    kept = [a for a in entry['annotations'] if a['created_by'] not in MACHINE or a['updated_by'] == 'human']
+    edited = [(a['bbox']['xmin'], a['bbox']['ymin'], a['bbox']['xmax'], a['bbox']['ymax']) for a in kept]
+    edited += list(deleted)
+    detections = [d for d in detections if all(iou(d, box) < overlap for box in edited)]
+    entry['annotations'] = kept + build_entry(detections, threshold, created_by)['annotations']
+    return entry
+
+
+class DetectionStore:
+    """Compact store of the raw detections from an annotation run.
+
+    Detections are appended per image and packed into numpy arrays on
+    demand so the run can be filtered again at any threshold above the
+    floor without inference.
+    """
+
+    def __init__(self, floor=0.0):
+        self.floor = floor
+        self.images = []
+        self.labels = []
+        self.label_index = {}
+        self.propagated = set()
+        self.deleted = {}
+        self.pending = []
+        self.image = np.zeros(0, dtype=np.int32)
+        self.label = np.zeros(0, dtype=np.int32)
+        self.boxes = np.zeros((0, 4), dtype=np.float64)
+        self.scores = np.zeros(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.images)
+
+    def add(self, image_name, detections, created_by='machine'):
+        """Append the raw detections of an image."""
+        index = len(self.images)
+        self.images.append(image_name)
+        if created_by == 'propagated':
+            self.propagated.add(image_name)
+        for x_min, y_min, x_max, y_max, confidence, label in detections:
+            if label not in self.label_index:
+                self.label_index[label] = len(self.labels)
+                self.labels.append(label)
+            self.pending.append((index, self.label_index[label], x_min, y_min, x_max, y_max, confidence))
+
+    def delete(self, image_name, annotation):
+        """Remember a machine box a human deleted, so filtering the run again
+        does not bring it back."""
+        if annotation['created_by'] in MACHINE:
+            bbox = annotation['bbox']
+            self.deleted.setdefault(image_name, []).append((bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax']))
+
+    def pack(self):
+        """Move pending detections into the arrays."""
+        if len(self.pending) == 0:
+            return
+        rows = np.array(self.pending, dtype=np.float64)
+        self.pending = []
+        self.image = np.concatenate((self.image, rows[:, 0].astype(np.int32)))
+        self.label = np.concatenate((self.label, rows[:, 1].astype(np.int32)))
+        self.boxes = np.concatenate((self.boxes, rows[:, 2:6]))
+        self.scores = np.concatenate((self.scores, rows[:, 6]))
+
+    def select(self, threshold):
+        """Return a dict of image name to raw detections above threshold,
+        images without detections map to an empty list."""
+        self.pack()
+        keep = np.flatnonzero(self.scores >= threshold)
+        selected = {image_name: [] for image_name in self.images}
+        if len(keep) == 0:
+            return selected
+        boxes = self.boxes[keep].tolist()
+        scores = self.scores[keep].tolist()
+        labels = self.label[keep].tolist()
+        for index, box, score, label in zip(self.image[keep].tolist(), boxes, scores, labels):
+            selected[self.images[index]].append(box + [score, self.labels[label]])
+        return selected
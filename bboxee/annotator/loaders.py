@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import os
+import math
+import cv2
+import numpy as np
+from PIL import Image
+from bboxee.annotator.masking import apply_mask
+from bboxee.annotator.tiling import tile_windows
+
+# Image loaders run in the decoding processes of shared_prefetch. They are
+# kept apart from the annotators so a decoding process only imports PIL,
+# OpenCV and numpy, not the deep learning framework or the gui.
+
+
+def open_image(file_name, image_size, reduced_decode=False):
+    """Open an image without decoding it, with reduced_decode JPEGs are set
+    to decode at the smallest scale that still covers image_size."""
+    image = Image.open(file_name)
+    ratio = image_size / max(image.size)
+    if reduced_decode and ratio < 1.0:
+        image.draft(image.mode, (math.ceil(image.width * ratio), math.ceil(image.height * ratio)))
+    return image
+
+
+def decoded_size(file_name, image_size, reduced_decode=False):
+    """(width, height) load_letterboxed will decode an image at, read from
+    the header only. Returns None if the file is missing or unreadable."""
+    if not os.path.exists(file_name):
+        return None
+    try:
+        with open_image(file_name, image_size, reduced_decode) as image:
+            return image.size
+    except OSError:
+        return None
+
+
+def letterbox_shape(width, height, image_size, stride):
+    """(height, width) letterbox(auto=True) pads an image of this size to."""
+    ratio = min(image_size / height, image_size / width)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+    return new_height + (image_size - new_height) % stride, new_width + (image_size - new_width) % stride
+
+
+def letterbox(img, image_size, stride=32, auto=True):
+    """Resize an HWC image to fit image_size and pad it with gray, pixel for
+    pixel the YOLOv5 letterbox. With auto, the padding is only what is
+    needed to reach a multiple of stride, otherwise the result is square."""
+    height, width = img.shape[:2]
+    ratio = min(image_size / height, image_size / width)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+    pad_width, pad_height = image_size - new_width, image_size - new_height
+    if auto:
+        pad_width, pad_height = pad_width % stride, pad_height % stride
+    if (new_width, new_height) != (width, height):
+        # Not PIL, which antialiases when shrinking
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_height / 2 - 0.1)), int(round(pad_height / 2 + 0.1))
+    left, right = int(round(pad_width / 2 - 0.1)), int(round(pad_width / 2 + 0.1))
+    return cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+
+def load_letterboxed(file_name, image_size, stride, reduced_decode=False, mask=None):
+    """Read and letterbox an image to CHW, returns None if the file is missing.
+
+    With reduced_decode, JPEGs are decoded by libjpeg at the smallest 1/2,
+    1/4 or 1/8 scale that still covers image_size. The returned shape is that
+    of the decoded image, which the boxes are normalized against. With a
+    mask, only the window around the unmasked pixels is letterboxed.
+    """
+    if not os.path.exists(file_name):
+        return None
+    image = open_image(file_name, image_size, reduced_decode)
+    img_original = np.asarray(image)
+    image.close()
+    img, window = apply_mask(img_original, mask)
+    img = letterbox(img, image_size, stride, auto=True)
+    img = img.transpose((2, 0, 1))  # HWC to CHW; PIL Image is RGB already
+    img = np.ascontiguousarray(img)
+    return (img_original.shape, window), img
+
+
+def load_tiles(file_name, image_size, stride, tile_size, overlap=0.2, full_frame=False, mask=None):
+    """Read an image and letterbox each of its tiles to image_size, returns
+    None if the file is missing. Tiles are padded to a square so they can
+    be stacked into one batch. With a mask, only the window around the
+    unmasked pixels is tiled."""
+    if not os.path.exists(file_name):
+        return None
+    image = Image.open(file_name)
+    img_original = np.asarray(image)
+    image.close()
+    img, window = apply_mask(img_original, mask)
+    height, width = img.shape[:2]
+    tiles = []
+    for x0, y0, x1, y1 in tile_windows(width, height, tile_size, overlap, full_frame):
+        tile = letterbox(img[y0:y1, x0:x1], image_size, stride, auto=False)
+        tiles.append(tile.transpose((2, 0, 1)))
+    return (img_original.shape, window), np.ascontiguousarray(np.stack(tiles))
+
+
+def load_array(file_name, mask=None):
+    """Read an image into an array, returns None if the file is missing.
+    With a mask, only the window around the unmasked pixels is returned."""
+    if not os.path.exists(file_name):
+        return None
+    image = Image.open(file_name)
+    # the array based representation of the image will be
+    # used later in order to prepare the result image with
+    # boxes and labels on it.
+    image_np = np.array(image)
+    image.close()
+    crop, window = apply_mask(image_np, mask)
+    return (image_np.shape, window), crop
+
+
+def load_bgr(file_name, mask=None):
+    """Read an image as a BGR array, returns None if the file is missing.
+    With a mask, only the window around the unmasked pixels is returned."""
+    if not os.path.exists(file_name):
+        return None
+    image = Image.open(file_name)
+    img_original = np.asarray(image.convert('RGB'))
+    image.close()
+    img, window = apply_mask(img_original, mask)
+    # Ultralytics expects numpy arrays to be BGR
+    return (img_original.shape, window), np.ascontiguousarray(img[:, :, ::-1])
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import hashlib
+import numpy as np
+from PIL import Image
+
+
+def mask_window(mask):
+    """Bounding rectangle (xmin, ymin, xmax, ymax) of the pixels a mask
+    keeps, None when it keeps none."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return (int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1)
+
+
+def scale_mask(mask, width, height):
+    """Resize a mask to width x height unless it already has that size."""
+    if mask.shape != (height, width):
+        mask = np.asarray(Image.fromarray(mask).resize((width, height), Image.NEAREST))
+    return mask
+
+
+def apply_mask(image, mask):
+    """Crop an image to the bounding rectangle of a mask and zero the masked
+    pixels, returns the crop and its window in image pixels.
+
+    The mask is a 2D array of zeros and ones. It is scaled to the image when
+    they differ in size, as with reduced scale decoding.
+    """
+    height, width = image.shape[:2]
+    if mask is None:
+        return image, (0, 0, width, height)
+    mask = scale_mask(mask, width, height)
+    window = mask_window(mask)
+    if window is None:
+        return image, (0, 0, width, height)
+    x0, y0, x1, y1 = window
+    region = mask[y0:y1, x0:x1]
+    if image.ndim == 3:
+        region = region[:, :, np.newaxis]
+    return image[y0:y1, x0:x1] * region, window
+
+
+def mask_key(mask):
+    """Describe a mask for the detection cache."""
+    if mask is None:
+        return ''
+    return '/mask/' + hashlib.sha1(np.ascontiguousarray(mask, dtype=np.uint8).tobytes()).hexdigest()[:16]
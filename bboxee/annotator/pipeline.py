@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import time
+import threading
+import numpy as np
+from PIL import Image
+import multiprocessing
+from itertools import islice
+from collections import deque
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Shared memory ring attached to by each decoding process and the function
+# it applies to each item
+_ring = None
+_function = None
+
+
+class Throughput:
+    """Accumulate the time spent and images handled by each pipeline stage."""
+
+    def __init__(self):
+        """Class init function."""
+        self.started = time.perf_counter()
+        self.seconds = {}
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, images=1):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.images[stage] = self.images.get(stage, 0) + images
+
+    def summary(self):
+        """Return a one line per stage report of images/sec."""
+        lines = []
+        for stage in self.seconds:
+            seconds = self.seconds[stage]
+            rate = self.images[stage] / seconds if seconds > 0 else 0.0
+            lines.append('{}: {} images, {:0.1f}s busy, {:0.1f} images/s'.format(stage, self.images[stage], seconds, rate))
+        lines.append('wall: {:0.1f}s'.format(time.perf_counter() - self.started))
+        return '\n'.join(lines)
+
+
+def bucket(items, keys, span=256):
+    """Reorder items so items with the same key are next to each other.
+
+    Items are only grouped within consecutive spans of span items, which
+    bounds how far results can run ahead of the original order. Buckets
+    keep the order of their first item, and items keep their original order
+    within a bucket.
+    """
+    ordered = []
+    for start in range(0, len(items), span):
+        buckets = {}
+        for item, key in zip(items[start:start + span], keys[start:start + span]):
+            buckets.setdefault(key, []).append(item)
+        for group in buckets.values():
+            ordered.extend(group)
+    return ordered
+
+
+def prefetch(function, items, workers=2, depth=8):
+    """Generator that applies function to each item on a pool of worker threads.
+
+    At most depth items are queued or being processed at any time, so the
+    workers stay only a few images ahead of the model. Results are yielded as
+    (item, result) tuples in the same order as items. Closing the generator,
+    e.g. when annotation is stopped, cancels any work that has not started.
+    """
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    pending = deque()
+    items = iter(items)
+    try:
+        for item in islice(items, max(1, depth)):
+            pending.append((item, pool.submit(function, item)))
+        while len(pending) > 0:
+            item, future = pending.popleft()
+            result = future.result()
+            # Top up the queue before handing the result back
+            for next_item in islice(items, 1):
+                pending.append((next_item, pool.submit(function, next_item)))
+            yield item, result
+    finally:
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+def _attach(name, slot_size, function):
+    """Process pool initializer, attach a decoding process to the ring. The
+    function, with any mask bound to it, is only pickled once per process."""
+    global _ring, _function
+    try:
+        memory = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13, the block is registered with the parent's resource
+        # tracker which is shared by the spawned processes
+        memory = shared_memory.SharedMemory(name=name)
+    _ring = (memory, slot_size)
+    _function = function
+
+
+def _fill(item, slot):
+    """Run the function on item in a decoding process and copy the resulting
+    array into its slot of the ring."""
+    start = time.perf_counter()
+    result = _function(item)
+    if result is not None:
+        meta, array = result
+        memory, slot_size = _ring
+        shape, dtype = array.shape, array.dtype
+        if array.nbytes <= slot_size:
+            view = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=slot * slot_size)
+            view[...] = array
+            array = None
+        # Arrays that do not fit in a slot are pickled back instead
+        result = (meta, shape, dtype, array)
+    return result, time.perf_counter() - start
+
+
+def shared_prefetch(function, items, slot_size, processes=2, slots=16, hold=1, stats=None):
+    """Generator that applies function to each item on a pool of processes.
+
+    function must be picklable and return None or a (meta, array) tuple. It
+    should live in a module that imports little, such as
+    bboxee.annotator.loaders, as each process imports it on start. The
+    arrays are written into a shared memory ring of fixed size slots and
+    yielded as (item, (meta, array)) tuples in the same order as items, where
+    array is a view into the ring. A slot is reused once the consumer has
+    requested hold more items, so views must be copied if they are kept
+    longer than that. When stats is set, decode and wait times are recorded.
+    """
+    slots = max(slots, hold + 1)
+    memory = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+    pool = ProcessPoolExecutor(max_workers=max(1, processes),
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_attach,
+                               initargs=(memory.name, slot_size, function))
+    pending = deque()
+    items = iter(items)
+    submitted = 0
+    yielded = 0
+    try:
+        while True:
+            released = max(0, yielded - hold)
+            for item in islice(items, slots - (submitted - released)):
+                pending.append((item, pool.submit(_fill, item, submitted % slots)))
+                submitted += 1
+            if len(pending) == 0:
+                break
+            item, future = pending.popleft()
+            start = time.perf_counter()
+            result, seconds = future.result()
+            if stats is not None:
+                stats.add('wait', time.perf_counter() - start)
+                stats.add('decode', seconds)
+            slot = yielded % slots
+            yielded += 1
+            if result is not None:
+                meta, shape, dtype, array = result
+                if array is None:
+                    array = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=slot * slot_size)
+                result = (meta, array)
+            yield item, result
+    finally:
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+        try:
+            memory.close()
+        except BufferError:
+            # Views into the ring are still referenced, the mapping is
+            # released when they are garbage collected
+            pass
+        memory.unlink()
+
+
+def image_bytes(file_name):
+    """Size in bytes of a decoded RGB image, only the header is read."""
+    image = Image.open(file_name)
+    width, height = image.size
+    image.close()
+    return width * height * 3
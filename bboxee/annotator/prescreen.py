@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import os
+import math
+import random
+import datetime
+import numpy as np
+from PIL import Image
+from bboxee.annotator.pipeline import prefetch
+
+
+def timestamp(image, file_name):
+    """Capture time of an image from its EXIF data, falling back to the
+    file modification time."""
+    exif = image.getexif()
+    value = exif.get_ifd(0x8769).get(36867) or exif.get(306)
+    if value:
+        try:
+            return datetime.datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S').timestamp()
+        except ValueError:
+            pass
+    return os.path.getmtime(file_name)
+
+
+def thumbnail(file_name, width=160):
+    """Read the capture time and a small grayscale copy of an image, JPEGs
+    are decoded at a reduced scale. Returns None if the file is missing."""
+    if not os.path.exists(file_name):
+        return None
+    image = Image.open(file_name)
+    height = max(1, round(width * image.height / image.width))
+    taken = timestamp(image, file_name)
+    image.draft('L', (width, height))
+    small = np.asarray(image.convert('L').resize((width, height), Image.BILINEAR), dtype=np.float32)
+    image.close()
+    return taken, small
+
+
+class Prescreen:
+    """Marks frames as likely empty so the detector can skip them.
+
+    Frames taken less than gap seconds apart form a burst. The median of a
+    burst of at least min_burst frames is its background, and a frame is
+    likely empty when less than area_threshold of its pixels differ from
+    the background by more than pixel_threshold gray levels. A random
+    audit_rate share of the likely empty frames is still passed through the
+    detector to estimate how many detections the skipping would miss.
+    """
+
+    def __init__(self, gap=10.0, min_burst=3, pixel_threshold=25, area_threshold=0.0005, audit_rate=0.02, width=160):
+        """Class init function."""
+        self.gap = gap
+        self.min_burst = min_burst
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+        self.audit_rate = audit_rate
+        self.width = width
+        self.screened = 0
+        self.bursts = 0
+        self.skipped = set()
+        self.audit = []
+
+    def screen(self, directory, queue, mask=None):
+        """Screen the (count, image_name) items of queue, returns the names of
+        the likely empty frames that should not be passed to the detector."""
+        self.screened = len(queue)
+        self.bursts = 0
+        self.skipped = set()
+        self.audit = []
+        files = [os.path.join(directory, image_name) for _, image_name in queue]
+        burst = []
+        last = None
+        for (_, image_name), (_, result) in zip(queue, prefetch(lambda f: thumbnail(f, self.width), files)):
+            if result is None:
+                continue
+            taken, small = result
+            if last is not None and abs(taken - last) > self.gap:
+                self.check(burst, mask)
+                burst = []
+            burst.append((image_name, small))
+            last = taken
+        self.check(burst, mask)
+        empty = sorted(self.skipped)
+        if len(empty) > 0:
+            self.audit = random.Random(0).sample(empty, max(1, math.ceil(len(empty) * self.audit_rate)))
+        self.skipped -= set(self.audit)
+        return set(self.skipped)
+
+    def check(self, burst, mask):
+        """Compare each frame of a burst to the burst background."""
+        if len(burst) < self.min_burst:
+            return
+        self.bursts += 1
+        frames = np.stack([small for _, small in burst])
+        keep = np.ones(frames.shape[1:], dtype=bool)
+        if mask is not None:
+            height, width = frames.shape[1:]
+            keep = np.asarray(Image.fromarray(mask).resize((width, height), Image.NEAREST)) > 0
+        background = np.median(frames, axis=0)
+        # Remove exposure changes between frames before differencing
+        difference = np.abs((frames - frames.mean(axis=(1, 2), keepdims=True)) - (background - background.mean()))
+        changed = ((difference > self.pixel_threshold) & keep).sum(axis=(1, 2)) / max(1, keep.sum())
+        for (image_name, _), area in zip(burst, changed):
+            if area < self.area_threshold:
+                self.skipped.add(image_name)
+
+    def summary(self, images):
+        """Report skip counts and how many audited frames had detections,
+        images is the annotation file 'images' dictionary of the run."""
+        empty = len(self.skipped) + len(self.audit)
+        missed = [image_name for image_name in self.audit if image_name in images and images[image_name]['annotations']]
+        lines = ['Prescreen: {} of {} frames likely empty ({:.1%}) in {} bursts, {} skipped'.format(
+            empty, self.screened, empty / max(1, self.screened), self.bursts, len(self.skipped))]
+        if len(self.audit) > 0:
+            lines.append('Audit: {} of {} likely empty frames had detections ({:.1%})'.format(
+                len(missed), len(self.audit), len(missed) / len(self.audit)))
+            for image_name in missed:
+                lines.append('  {}'.format(image_name))
+        return '\n'.join(lines)
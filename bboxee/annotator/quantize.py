@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import os
+import json
+import time
+import torch
+import numpy as np
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from yolov5.utils.general import non_max_suppression
+from yolov5.utils.metrics import box_iou
+from bboxee.annotator.yolo_onnx import export, load_names, load_session, to_yolov5_layout
+
+MODES = ['dynamic', 'static']
+
+
+def fp32_file(model_file, family='yolov5', image_size=640):
+    """Return the FP32 ONNX model for a checkpoint, exporting it next to the
+    checkpoint when it is missing or older than the checkpoint."""
+    if model_file.endswith('.onnx'):
+        return model_file
+    output_file = os.path.splitext(model_file)[0] + '.onnx'
+    if not os.path.exists(output_file) or os.path.getmtime(output_file) < os.path.getmtime(model_file):
+        if family == 'yolov9':
+            from ultralytics import YOLO
+            output_file = YOLO(model_file).export(format='onnx', dynamic=True, imgsz=image_size)
+        else:
+            export(model_file, output_file, image_size)
+    return output_file
+
+
+def sample(files, count=32):
+    """Pick up to count files spread evenly over the list."""
+    if len(files) <= count:
+        return list(files)
+    step = len(files) / count
+    return [files[int(index * step)] for index in range(count)]
+
+
+class CalibrationReader(CalibrationDataReader):
+    """Feed letterboxed images to the static quantization calibrator."""
+
+    def __init__(self, input_name, files, load):
+        self.input_name = input_name
+        self.files = iter(files)
+        self.load = load
+
+    def get_next(self):
+        for file_name in self.files:
+            prepared = self.load(file_name)
+            if prepared is not None:
+                return {self.input_name: prepared[1][np.newaxis].astype(np.float32) / 255}
+        return None
+
+
+def quantize(model_file, mode, files, load, family='yolov5', image_size=640):
+    """Return an INT8 copy of a checkpoint or ONNX model.
+
+    The quantized model and its agreement report are cached next to the
+    model file and reused until the model changes. files are the
+    calibration images, load is the function that letterboxes them.
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown quantization mode: {}'.format(mode))
+    source = fp32_file(model_file, family, image_size)
+    output_file = '{}.int8-{}.onnx'.format(os.path.splitext(model_file)[0], mode)
+    report_file = os.path.splitext(output_file)[0] + '.json'
+    if os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(source):
+        if os.path.exists(report_file):
+            with open(report_file, 'r') as file:
+                print(format_report(json.load(file)))
+        return output_file
+    if mode == 'static':
+        input_name = load_session(source).get_inputs()[0].name
+        reader = CalibrationReader(input_name, files, load)
+        quantize_static(source, output_file, reader,
+                        quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8)
+    else:
+        quantize_dynamic(source, output_file, weight_type=QuantType.QUInt8)
+    report = agreement(source, output_file, files, load)
+    report['mode'] = mode
+    with open(report_file, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(format_report(report))
+    return output_file
+
+
+def detect(session, image, classes, conf_thres):
+    """Run one image through a session, returns the detections after NMS."""
+    pred = session.run(None, {session.get_inputs()[0].name: image})[0]
+    pred = to_yolov5_layout(pred, classes)
+    return non_max_suppression(torch.from_numpy(pred), conf_thres=conf_thres)[0]
+
+
+def agreement(fp32_model, int8_model, files, load, conf_thres=0.25, iou_thres=0.5):
+    """Compare the INT8 detections with the FP32 detections on the
+    calibration images. Each FP32 box is matched to the INT8 box it
+    overlaps most, a match needs an IoU of at least iou_thres."""
+    reference = load_session(fp32_model)
+    candidate = load_session(int8_model)
+    classes = len(load_names(reference))
+    report = {'images': 0,
+              'fp32_boxes': 0,
+              'int8_boxes': 0,
+              'matched': 0,
+              'same_label': 0,
+              'mean_iou': 0.0,
+              'iou_threshold': iou_thres,
+              'fp32_seconds': 0.0,
+              'int8_seconds': 0.0}
+    ious = []
+    for file_name in files:
+        prepared = load(file_name)
+        if prepared is None:
+            continue
+        image = prepared[1][np.newaxis].astype(np.float32) / 255
+        start = time.perf_counter()
+        expected = detect(reference, image, classes, conf_thres)
+        report['fp32_seconds'] += time.perf_counter() - start
+        start = time.perf_counter()
+        found = detect(candidate, image, classes, conf_thres)
+        report['int8_seconds'] += time.perf_counter() - start
+        report['images'] += 1
+        report['fp32_boxes'] += len(expected)
+        report['int8_boxes'] += len(found)
+        if len(expected) and len(found):
+            best, index = box_iou(expected[:, :4], found[:, :4]).max(1)
+            matched = best >= iou_thres
+            report['matched'] += int(matched.sum())
+            report['same_label'] += int((expected[matched, 5] == found[index[matched], 5]).sum())
+            ious += best[matched].tolist()
+    report['mean_iou'] = float(np.mean(ious)) if ious else 0.0
+    return report
+
+
+def format_report(report):
+    """One line summary of an agreement report."""
+    matched = report['matched'] / max(report['fp32_boxes'], 1)
+    same_label = report['same_label'] / max(report['matched'], 1)
+    speedup = report['fp32_seconds'] / report['int8_seconds'] if report['int8_seconds'] > 0 else 0.0
+    message = 'INT8 {} agreement on {} images: {} of {} FP32 boxes matched at IoU >= {} ({:.1%}), mean IoU {:.3f}, '
+    message += 'same label on {:.1%} of matches, {} INT8 boxes, {:.2f}x faster'
+    return message.format(report.get('mode', ''), report['images'], report['matched'], report['fp32_boxes'],
+                          report['iou_threshold'], matched, report['mean_iou'], same_label, report['int8_boxes'], speedup)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import os
+import threading
+from collections import OrderedDict
+
+
+class ModelRegistry:
+    """Process wide cache that keeps loaded models warm between runs.
+
+    Models are keyed by (backend, path, mtime, size, device), so a model that
+    changes on disk is loaded again. The least recently used models are
+    dropped once more than max_models are loaded or their combined size on
+    disk exceeds max_bytes. The most recently loaded model is always kept.
+    """
+
+    def __init__(self, max_models=3, max_bytes=4 * 1024 ** 3):
+        """Class init function."""
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, backend, path, device):
+        """Build the cache key, directories such as saved models are
+        summarized by their total size and newest file."""
+        if os.path.isdir(path):
+            mtime = 0.0
+            size = 0
+            for dirpath, _, files in os.walk(path):
+                for file_name in files:
+                    stat = os.stat(os.path.join(dirpath, file_name))
+                    mtime = max(mtime, stat.st_mtime)
+                    size += stat.st_size
+        else:
+            stat = os.stat(path)
+            mtime = stat.st_mtime
+            size = stat.st_size
+        return (backend, os.path.abspath(path), mtime, size, device)
+
+    def get(self, backend, path, device, loader):
+        """Return the model for path, calling loader() to load it on a miss."""
+        key = self.key(backend, path, device)
+        # Loading is done under the lock so two annotators asking for the
+        # same model at the same time only load it once
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            model = loader()
+            self.models[key] = model
+            self.evict()
+            return model
+
+    def evict(self):
+        """Drop least recently used models until the limits are met."""
+        while len(self.models) > 1:
+            size = sum(key[3] for key in self.models)
+            if len(self.models) <= self.max_models and size <= self.max_bytes:
+                break
+            self.models.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+
+registry = ModelRegistry()
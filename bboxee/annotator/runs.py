@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import os
+from bboxee import schema
+from bboxee.annotator.detections import DetectionStore, build_entry
+from bboxee.annotator.detection_cache import model_fingerprint
+
+
+def start_run(annotator, model_path):
+    """Reset an annotator for a new run and sort out the images that skip
+    inference.
+
+    Detections are kept down to detection_floor, so the run can be filtered
+    again at a different threshold and the cache serves any threshold.
+    Cached detections, likely empty frames and near duplicates are set on
+    the annotator as cached, skipped and followers. Returns the queue of
+    (count, image name) tuples and the misses that still need inference.
+    """
+    annotator.stop = False
+    annotator.stats = None
+    annotator.data = schema.annotation_file()
+    annotator.data['analysts'].append('Machine Generated')
+    queue = list(enumerate(annotator.image_list))[annotator.starting_image:]
+    annotator.floor = min(annotator.threshold, annotator.detection_floor)
+    annotator.store = DetectionStore(annotator.floor)
+    cached = {}
+    if annotator.cache is not None:
+        annotator.fingerprint = model_fingerprint(model_path)
+        files = [os.path.join(annotator.image_directory, image_name) for _, image_name in queue]
+        cached = annotator.cache.lookup(files, annotator.fingerprint, annotator.input_key(), annotator.threshold)
+    misses = [item for item in queue if os.path.join(annotator.image_directory, item[1]) not in cached]
+    skipped = set()
+    if annotator.prescreen is not None:
+        skipped = annotator.prescreen.screen(annotator.image_directory, misses, annotator.mask)
+        misses = [item for item in misses if item[1] not in skipped]
+    followers = {}
+    if annotator.dedup is not None:
+        followers = annotator.dedup.group(annotator.image_directory, misses, annotator.mask)
+        misses = [item for item in misses if item[1] not in followers]
+    annotator.cached, annotator.skipped, annotator.followers = cached, skipped, followers
+    return queue, misses
+
+
+def screened(annotator, image_name):
+    """True when an image skips inference, because it is cached, likely
+    empty or a near duplicate."""
+    file_name = os.path.join(annotator.image_directory, image_name)
+    return file_name in annotator.cached or image_name in annotator.skipped or image_name in annotator.followers
+
+
+def emit_screened(annotator, count, image_name):
+    """Emit an image that skips inference with its cached detections, the
+    detections of its representative when it is a near duplicate and none
+    when it is likely empty."""
+    file_name = os.path.join(annotator.image_directory, image_name)
+    if image_name in annotator.followers:
+        annotator.emit(count, image_name, annotator.dedup.detections(image_name), True, 'propagated')
+    else:
+        annotator.emit(count, image_name, annotator.cached.get(file_name, []), True)
+
+
+def emit_detections(annotator, count, image_name, detections, cached=False, created_by='machine'):
+    """Cache the raw detections of an image and emit those above threshold."""
+    if annotator.cache is not None and not cached:
+        file_name = os.path.join(annotator.image_directory, image_name)
+        annotator.cache.store(file_name, annotator.fingerprint, annotator.input_key(), annotator.floor, detections)
+    if annotator.dedup is not None:
+        annotator.dedup.record(image_name, detections)
+    annotator.store.add(image_name, detections, created_by)
+    entry = build_entry(detections, annotator.threshold, created_by)
+    if len(entry['annotations']) > 0:
+        annotator.data['images'][image_name] = entry
+    annotator.progress.emit(count + 1, image_name, entry)
+
+
+def finish_run(annotator):
+    """Commit the detection cache, print the run summaries and emit the
+    annotations of the run."""
+    if annotator.stats is not None:
+        print(annotator.stats.summary())
+    if annotator.cache is not None:
+        annotator.cache.flush()
+        print(annotator.cache.summary())
+    if annotator.prescreen is not None:
+        print(annotator.prescreen.summary(annotator.data['images']))
+    if annotator.dedup is not None:
+        print(annotator.dedup.summary())
+    annotator.finished.emit(annotator.data)
@@ -23,10 +23,17 @@
 #
 # --------------------------------------------------------------------------
 import os
+import time
 import json
-from PIL import Image
+from functools import partial
 from PyQt6 import QtCore
-from bboxee import schema
+from bboxee.annotator.pipeline import Throughput, image_bytes, prefetch, shared_prefetch
+from bboxee.annotator.registry import registry
+from bboxee.annotator.detections import DetectionStore
+from bboxee.annotator.loaders import load_array
+from bboxee.annotator.masking import mask_key
+from bboxee.annotator.tiling import merge, shift, tile_windows
+from bboxee.annotator.runs import emit_detections, emit_screened, finish_run, screened, start_run
 import tensorflow.compat.v1 as tf
 import numpy as np
 
@@ -47,8 +54,28 @@ class Annotator(QtCore.QThread):
         self.starting_image = 0
         self.image_directory = ''
         self.data = None
-        self.detection_graph = tf.Graph()
+        self.detection_graph = None
         self.inference_graph = inference_graph
+        self.prefetch_workers = 2
+        self.prefetch_depth = 8
+        self.decode_processes = 0
+        self.ring_slots = 16
+        self.stats = None
+        self.cache = None
+        self.detection_floor = 0.05
+        self.store = DetectionStore()
+        self.fingerprint = ''
+        self.floor = self.threshold
+        self.tile_size = 0
+        self.tile_overlap = 0.2
+        self.tile_full_frame = False
+        self.tile_merge = 'nms'
+        self.mask = None
+        self.prescreen = None
+        self.dedup = None
+        self.cached = {}
+        self.skipped = set()
+        self.followers = {}
         self.label_map = self.build_label_map(label_map)
 
     def build_label_map(self, file_name):
@@ -83,78 +110,119 @@ class Annotator(QtCore.QThread):
                 label_map[entry['id']] = entry['name']
         return label_map
 
-    def run(self):
-        """The starting point for the thread."""
-        self.stop = False
-        self.data = schema.annotation_file()
-        self.data['analysts'].append('Machine Generated')
-        with self.detection_graph.as_default():
-            graph_def = self.detection_graph.as_graph_def()
+    def load_graph(self):
+        """Read the frozen inference graph into a new graph."""
+        graph = tf.Graph()
+        with graph.as_default():
+            graph_def = graph.as_graph_def()
             with tf.io.gfile.GFile(self.inference_graph, 'rb') as fid:
                 serialized_graph = fid.read()
                 graph_def.ParseFromString(serialized_graph)
                 tf.import_graph_def(graph_def, name='')
-            self.model_loaded.emit()
-            with tf.Session(graph=self.detection_graph) as sess:
-                # Definite input and output Tensors for detection_graph
-                image_tensor = (self.detection_graph.
-                                get_tensor_by_name('image_tensor:0'))
-                # Each box represents a part of the image where a
-                # particular object was detected.
-                d_boxes = (self.detection_graph.
-                           get_tensor_by_name('detection_boxes:0'))
-                # Each score represent how level of confidence for each of
-                # the objects. Score is shown on the result image,
-                # together with the class label.
-                d_scores = (self.detection_graph.
-                            get_tensor_by_name('detection_scores:0'))
-                d_classes = (self.detection_graph.
-                             get_tensor_by_name('detection_classes:0'))
-                num_detections = (self.detection_graph.
-                                  get_tensor_by_name('num_detections:0'))
-                for count, img in enumerate(self.image_list):
-                    if count >= self.starting_image:
-                        if self.stop:
-                            break
-                        file_name = os.path.join(self.image_directory, img)
-                        if os.path.exists(file_name):
-                            image = Image.open(file_name)
-                            # the array based representation of the image will be
-                            # used later in order to prepare the result image with
-                            # boxes and labels on it.
-                            image_np = np.array(image)
-                            # Expand dimensions since the model expects images
-                            # to have shape: [1, None, None, 3]
-                            image_np_expanded = np.expand_dims(image_np, axis=0)
-                            # Actual detection.
-                            fd = {image_tensor: image_np_expanded}
-                            (boxes, scores, classes, num) = sess.run([d_boxes, d_scores, d_classes, num_detections], feed_dict=fd)
-                            boxes = np.squeeze(boxes)
-                            scores = np.squeeze(scores)
-                            classes = np.squeeze(classes)
-                            entry = schema.annotation_file_entry()
-                            for i in range(len(scores)):
-                                if scores[i] >= self.threshold:
-                                    annotation = schema.annotation()
-                                    annotation['created_by'] = 'machine'
-                                    annotation['confidence'] = float(scores[i])
-                                    bbox = boxes[i]
-                                    annotation['bbox']['xmin'] = float(bbox[1])
-                                    annotation['bbox']['xmax'] = float(bbox[3])
-                                    annotation['bbox']['ymin'] = float(bbox[0])
-                                    annotation['bbox']['ymax'] = float(bbox[2])
-                                    if classes[i] in self.label_map:
-                                        label = self.label_map[classes[i]]
-                                    else:
-                                        label = 'unknown'
-                                    # label = self.category_index[classes[i]]['name']
-                                    annotation['label'] = label
-                                    entry['annotations'].append(annotation)
-                            if len(entry['annotations']) > 0:
-                                self.data['images'][img] = entry
-                            image.close()
-                            self.progress.emit(count + 1, img, entry)
-        self.finished.emit(self.data)
+        return graph
+
+    def run(self):
+        """The starting point for the thread."""
+        queue, misses = start_run(self, self.inference_graph)
+        try:
+            if len(misses) == 0:
+                # Everything was served from the cache, skip loading the graph
+                self.model_loaded.emit()
+                for count, img in queue:
+                    if self.stop:
+                        break
+                    emit_screened(self, count, img)
+            else:
+                self.detection_graph = registry.get('tensorflow_v1', self.inference_graph, 'default', self.load_graph)
+                with self.detection_graph.as_default():
+                    self.model_loaded.emit()
+                    with tf.Session(graph=self.detection_graph) as sess:
+                        self.annotate(sess, queue, misses)
+        finally:
+            # Also on errors, so the detections cached so far are committed
+            finish_run(self)
+
+    def annotate(self, sess, queue, misses):
+        """Pass the images that were not cached through the session."""
+        # Definite input and output Tensors for detection_graph
+        image_tensor = (self.detection_graph.
+                        get_tensor_by_name('image_tensor:0'))
+        # Each box represents a part of the image where a
+        # particular object was detected.
+        d_boxes = (self.detection_graph.
+                   get_tensor_by_name('detection_boxes:0'))
+        # Each score represent how level of confidence for each of
+        # the objects. Score is shown on the result image,
+        # together with the class label.
+        d_scores = (self.detection_graph.
+                    get_tensor_by_name('detection_scores:0'))
+        d_classes = (self.detection_graph.
+                     get_tensor_by_name('detection_classes:0'))
+        num_detections = (self.detection_graph.
+                          get_tensor_by_name('num_detections:0'))
+        files = [os.path.join(self.image_directory, image_name) for _, image_name in misses]
+        function = partial(load_array, mask=self.mask)
+        if self.decode_processes > 0:
+            # Slots are sized to the first image, larger images are copied
+            first = next((f for f in files if os.path.exists(f)), None)
+            slot_size = image_bytes(first) if first is not None else 1
+            self.stats = Throughput()
+            images = shared_prefetch(function, files, slot_size, self.decode_processes, self.ring_slots, 1, self.stats)
+        else:
+            images = prefetch(function, files, self.prefetch_workers, self.prefetch_depth)
+        for count, img in queue:
+            if self.stop:
+                break
+            if screened(self, img):
+                # Cached, likely empty and duplicate frames skip inference
+                emit_screened(self, count, img)
+                continue
+            _, prepared = next(images)
+            if prepared is not None:
+                (original_shape, (left, top, _, _)), image_np = prepared
+                height, width = image_np.shape[:2]
+                windows = [(0, 0, width, height)]
+                if self.tile_size > 0:
+                    windows = tile_windows(width, height, self.tile_size, self.tile_overlap, self.tile_full_frame)
+                # Tiles of the same size are passed through the graph together
+                groups = {}
+                for x0, y0, x1, y1 in windows:
+                    groups.setdefault((y1 - y0, x1 - x0), []).append((x0, y0, x1, y1))
+                detections = []
+                seconds = 0.0
+                for group in groups.values():
+                    # The model expects images to have shape: [N, None, None, 3]
+                    crops = np.stack([image_np[y0:y1, x0:x1] for x0, y0, x1, y1 in group])
+                    # Actual detection.
+                    fd = {image_tensor: crops}
+                    start = time.perf_counter()
+                    (boxes, scores, classes, num) = sess.run([d_boxes, d_scores, d_classes, num_detections], feed_dict=fd)
+                    seconds += time.perf_counter() - start
+                    classes = classes.astype(int)
+                    for row, (x0, y0, x1, y1) in enumerate(group):
+                        mask = scores[row] >= self.floor
+                        # Model boxes are ymin, xmin, ymax, xmax normalized to the window
+                        shifted = shift(boxes[row][mask][:, [1, 0, 3, 2]], (left + x0, top + y0, left + x1, top + y1),
+                                        original_shape[1], original_shape[0])
+                        for box, score, class_number in zip(shifted.tolist(), scores[row][mask].tolist(), classes[row][mask].tolist()):
+                            detections.append(box + [score, self.label_map.get(class_number, 'unknown')])
+                if self.stats is not None:
+                    self.stats.add('inference', seconds)
+                if self.tile_size > 0:
+                    detections = merge(detections, method=self.tile_merge)
+                self.emit(count, img, detections)
+        images.close()
+
+    def input_key(self):
+        """Describe the preprocessing that detections depend on."""
+        key = 'tensorflow_v1'
+        if self.tile_size > 0:
+            key += '/tiles/{}/{}/{}/{}'.format(self.tile_size, self.tile_overlap, int(self.tile_full_frame), self.tile_merge)
+        return key + mask_key(self.mask)
+
+    def emit(self, count, image_name, detections, cached=False, created_by='machine'):
+        """Cache the raw detections of an image and emit those above threshold."""
+        emit_detections(self, count, image_name, detections, cached, created_by)
 
     def stop_annotation(self):
         self.stop = True
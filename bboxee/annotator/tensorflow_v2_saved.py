@@ -23,10 +23,17 @@
 #
 # --------------------------------------------------------------------------
 import os
+import time
 import json
-from PIL import Image
+from functools import partial
 from PyQt6 import QtCore
-from bboxee import schema
+from bboxee.annotator.pipeline import Throughput, image_bytes, prefetch, shared_prefetch
+from bboxee.annotator.registry import registry
+from bboxee.annotator.detections import DetectionStore
+from bboxee.annotator.loaders import load_array
+from bboxee.annotator.masking import mask_key
+from bboxee.annotator.tiling import merge, shift, tile_windows
+from bboxee.annotator.runs import emit_detections, emit_screened, finish_run, screened, start_run
 import tensorflow as tf
 import numpy as np
 
@@ -38,7 +45,7 @@ class Annotator(QtCore.QThread):
     finished = QtCore.pyqtSignal(dict)
     model_loaded = QtCore.pyqtSignal()
 
-    def __init__(self, model_dir, label_map):
+    def __init__(self, model_dir, label_map, batch_size=1):
         """Class init function."""
         QtCore.QThread.__init__(self)
         self.stop = False
@@ -49,6 +56,28 @@ class Annotator(QtCore.QThread):
         self.data = None
         self.model = None
         self.model_dir = model_dir
+        self.batch_size = max(1, batch_size)
+        self.functions = {}
+        self.prefetch_workers = 2
+        self.prefetch_depth = 8
+        self.decode_processes = 0
+        self.ring_slots = 16
+        self.stats = None
+        self.cache = None
+        self.detection_floor = 0.05
+        self.store = DetectionStore()
+        self.fingerprint = ''
+        self.floor = self.threshold
+        self.tile_size = 0
+        self.tile_overlap = 0.2
+        self.tile_full_frame = False
+        self.tile_merge = 'nms'
+        self.mask = None
+        self.prescreen = None
+        self.dedup = None
+        self.cached = {}
+        self.skipped = set()
+        self.followers = {}
         self.label_map = self.build_label_map(label_map)
 
     def build_label_map(self, file_name):
@@ -83,56 +112,171 @@ class Annotator(QtCore.QThread):
                 label_map[entry['id']] = entry['name']
         return label_map
 
+    def raw_detections(self, scores, boxes, classes, window, width, height):
+        """Convert model output for a window of an image to [xmin, ymin, xmax,
+        ymax, confidence, label] lists normalized to the full image."""
+        # Model boxes are ymin, xmin, ymax, xmax normalized to the window
+        boxes = shift(boxes[:, [1, 0, 3, 2]], window, width, height)
+        detections = []
+        for score, box, class_number in zip(scores.tolist(), boxes.tolist(), classes.tolist()):
+            detections.append(box + [score, self.label_map.get(class_number, 'unknown')])
+        return detections
+
+    def detect(self, window):
+        """Group a window of images by resolution, pass each group through the
+        model in fixed shape batches and emit the detections in window order."""
+        buckets = {}
+        for item in window:
+            buckets.setdefault(item[2].shape, []).append(item)
+        detections = {}
+        for shape, bucket in buckets.items():
+            # Decided once per resolution, so a fall back to single images
+            # cannot change the step of the loop below
+            size = self.batch_size if self.trace((self.batch_size,) + shape, bucket[0][2].dtype) else 1
+            for index in range(0, len(bucket), size):
+                batch = bucket[index:index + size]
+                images = np.stack([item[2] for item in batch])
+                if len(batch) < size:
+                    # Pad the last batch so every call reuses the same trace
+                    padding = np.zeros((size - len(batch),) + shape, dtype=images.dtype)
+                    images = np.concatenate((images, padding))
+                start = time.perf_counter()
+                dets = self.inference(images)
+                if self.stats is not None:
+                    self.stats.add('inference', time.perf_counter() - start, len(batch))
+                scores = dets['detection_scores'].numpy()
+                boxes = dets['detection_boxes'].numpy()
+                classes = dets['detection_classes'].numpy().astype(int)
+                keep = scores >= self.floor
+                for row, (count, img, _, (frame_shape, frame)) in enumerate(batch):
+                    mask = keep[row]
+                    detections[count] = self.raw_detections(scores[row][mask], boxes[row][mask], classes[row][mask],
+                                                            frame, frame_shape[1], frame_shape[0])
+        for count, img, _, _ in window:
+            self.emit(count, img, detections[count])
+
+    def input_key(self):
+        """Describe the preprocessing that detections depend on."""
+        key = 'tensorflow_v2'
+        if self.tile_size > 0:
+            key += '/tiles/{}/{}/{}/{}'.format(self.tile_size, self.tile_overlap, int(self.tile_full_frame), self.tile_merge)
+        return key + mask_key(self.mask)
+
+    def emit(self, count, image_name, detections, cached=False, created_by='machine'):
+        """Cache the raw detections of an image and emit those above threshold."""
+        emit_detections(self, count, image_name, detections, cached, created_by)
+
+    def inference(self, images):
+        """Call the model through a concrete function cached per input shape."""
+        if self.trace(images.shape, images.dtype):
+            return self.functions[images.shape](tf.constant(images))
+        return self.single(images)
+
+    def trace(self, shape, dtype):
+        """Trace a concrete function for a batch shape once, returns False
+        when images are passed to the model one at a time."""
+        if self.batch_size == 1:
+            return False
+        if shape not in self.functions:
+            try:
+                function = tf.function(lambda batch: self.model(batch))
+                self.functions[shape] = function.get_concrete_function(tf.TensorSpec(shape, tf.as_dtype(dtype)))
+            except (ValueError, TypeError):
+                # Models exported with a fixed batch dimension of one
+                print('Model does not accept batches, falling back to a batch size of 1')
+                self.batch_size = 1
+                return False
+        return True
+
+    def single(self, images):
+        """Call the model one image at a time and concatenate the results."""
+        results = [self.model(image[np.newaxis]) for image in images]
+        keys = ['detection_scores', 'detection_boxes', 'detection_classes']
+        return {key: tf.concat([result[key] for result in results], 0) for key in keys}
+
+    def detect_tiles(self, count, image_name, image, region):
+        """Pass the tiles of an image through the model, tiles of the same size
+        as one batch, shift the boxes back to the full image and merge
+        duplicates across seams."""
+        original_shape, (left, top, _, _) = region
+        groups = {}
+        for x0, y0, x1, y1 in tile_windows(image.shape[1], image.shape[0], self.tile_size, self.tile_overlap, self.tile_full_frame):
+            groups.setdefault((y1 - y0, x1 - x0), []).append((x0, y0, x1, y1))
+        detections = []
+        seconds = 0.0
+        for windows in groups.values():
+            crops = np.stack([image[y0:y1, x0:x1] for x0, y0, x1, y1 in windows])
+            start = time.perf_counter()
+            dets = self.inference(crops)
+            seconds += time.perf_counter() - start
+            scores = dets['detection_scores'].numpy()
+            boxes = dets['detection_boxes'].numpy()
+            classes = dets['detection_classes'].numpy().astype(int)
+            keep = scores >= self.floor
+            for row, (x0, y0, x1, y1) in enumerate(windows):
+                mask = keep[row]
+                detections += self.raw_detections(scores[row][mask], boxes[row][mask], classes[row][mask],
+                                                  (left + x0, top + y0, left + x1, top + y1),
+                                                  original_shape[1], original_shape[0])
+        if self.stats is not None:
+            self.stats.add('inference', seconds)
+        self.emit(count, image_name, merge(detections, method=self.tile_merge))
+
     def run(self):
         """The starting point for the thread."""
-        self.stop = False
-        self.data = schema.annotation_file()
-        self.data['analysts'].append('Machine Generated')
-        if self.model is None:
-            self.model = tf.saved_model.load(self.model_dir)
-        self.model_loaded.emit()
-        for count, img in enumerate(self.image_list):
-            if count >= self.starting_image:
+        queue, misses = start_run(self, self.model_dir)
+        try:
+            if len(misses) > 0:
+                model = registry.get('tensorflow_v2', self.model_dir, 'default', lambda: tf.saved_model.load(self.model_dir))
+                if model is not self.model:
+                    self.model = model
+                    self.functions = {}
+            self.model_loaded.emit()
+            # Images are collected into windows, bucketed by resolution inside
+            # the window and then emitted in their original order
+            window_size = self.batch_size * 4
+            files = [os.path.join(self.image_directory, image_name) for _, image_name in misses]
+            function = partial(load_array, mask=self.mask)
+            if self.decode_processes > 0:
+                # Slots are sized to the first image, larger images are copied
+                first = next((f for f in files if os.path.exists(f)), None)
+                slot_size = image_bytes(first) if first is not None else 1
+                self.stats = Throughput()
+                images = shared_prefetch(function, files, slot_size, self.decode_processes, self.ring_slots, 1, self.stats)
+            else:
+                images = prefetch(function, files, self.prefetch_workers, self.prefetch_depth)
+            window = []
+            for count, img in queue:
                 if self.stop:
                     break
-                file_name = os.path.join(self.image_directory, img)
-                if os.path.exists(file_name):
-                    image = Image.open(file_name)
-                    # the array based representation of the image will be
-                    # used later in order to prepare the result image with
-                    # boxes and labels on it.
-                    image_np = np.array(image)
-                    # Expand dimensions since the model expects images
-                    # to have shape: [1, None, None, 3]
-                    image_np_expanded = np.expand_dims(image_np, axis=0)
-                    # Actual detection.
-                    dets = self.model(image_np_expanded)
-                    entry = schema.annotation_file_entry()
-                    scores = dets['detection_scores'][0].numpy()
-                    boxes = dets['detection_boxes'][0].numpy()
-                    classes = dets['detection_classes'][0].numpy()
-                    for index, score in enumerate(scores):
-                        if score >= self.threshold:
-                            annotation = schema.annotation()
-                            annotation['created_by'] = 'machine'
-                            annotation['confidence'] = float(score)
-                            bbox = boxes[index]
-                            annotation['bbox']['xmin'] = float(bbox[1])
-                            annotation['bbox']['xmax'] = float(bbox[3])
-                            annotation['bbox']['ymin'] = float(bbox[0])
-                            annotation['bbox']['ymax'] = float(bbox[2])
-                            class_number = int(classes[index])
-                            if class_number in self.label_map:
-                                label = self.label_map[class_number]
-                            else:
-                                label = 'unknown'
-                            annotation['label'] = label
-                            entry['annotations'].append(annotation)
-                    if len(entry['annotations']) > 0:
-                        self.data['images'][img] = entry
-                    image.close()
-                    self.progress.emit(count + 1, img, entry)
-        self.finished.emit(self.data)
+                if screened(self, img):
+                    # Cached, likely empty and duplicate frames skip inference,
+                    # flush the window first to keep the progress in order
+                    if len(window) > 0:
+                        self.detect(window)
+                        window = []
+                    emit_screened(self, count, img)
+                    continue
+                _, prepared = next(images)
+                if prepared is not None:
+                    region, image = prepared
+                    if self.tile_size > 0:
+                        self.detect_tiles(count, img, image, region)
+                        continue
+                    if self.decode_processes > 0:
+                        # Copied out of the ring, so it does not have to hold a
+                        # whole window of frames, they are stacked anyway
+                        image = image.copy()
+                    window.append((count, img, image, region))
+                    if len(window) == window_size:
+                        self.detect(window)
+                        window = []
+            if len(window) > 0 and not self.stop:
+                self.detect(window)
+            images.close()
+        finally:
+            # Also on errors, so the detections cached so far are committed
+            finish_run(self)
 
     def stop_annotation(self):
         self.stop = True
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import numpy as np
+
+METHODS = ['nms', 'wbf']
+
+
+def starts(length, tile_size, step):
+    """Start positions of tiles along one axis, the last tile ends at the edge."""
+    if length <= tile_size:
+        return [0]
+    return list(range(0, length - tile_size, step)) + [length - tile_size]
+
+
+def tile_windows(width, height, tile_size, overlap=0.2, full_frame=False):
+    """Pixel windows (xmin, ymin, xmax, ymax) of overlapping tiles covering
+    an image. With full_frame the whole image is the first window."""
+    step = max(1, int(tile_size * (1.0 - overlap)))
+    windows = [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+               for y in starts(height, tile_size, step)
+               for x in starts(width, tile_size, step)]
+    if full_frame and windows != [(0, 0, width, height)]:
+        windows.insert(0, (0, 0, width, height))
+    return windows
+
+
+def shift(boxes, window, width, height):
+    """Map (N, 4) xmin, ymin, xmax, ymax boxes normalized to a window to
+    boxes normalized to the full image."""
+    x0, y0, x1, y1 = window
+    scale = np.array([x1 - x0, y1 - y0, x1 - x0, y1 - y0], dtype=np.float64)
+    offset = np.array([x0, y0, x0, y0], dtype=np.float64)
+    size = np.array([width, height, width, height], dtype=np.float64)
+    return (np.asarray(boxes, dtype=np.float64).reshape(-1, 4) * scale + offset) / size
+
+
+def place(boxes, window, width, height):
+    """Map (N, 4) xmin, ymin, xmax, ymax boxes in pixels of a window to
+    boxes normalized to the full image."""
+    x0, y0 = window[:2]
+    offset = np.array([x0, y0, x0, y0], dtype=np.float64)
+    size = np.array([width, height, width, height], dtype=np.float64)
+    return (np.asarray(boxes, dtype=np.float64).reshape(-1, 4) + offset) / size
+
+
+def merge(detections, threshold=0.5, method='nms'):
+    """Merge duplicate raw detections from overlapping tiles.
+
+    Boxes of the same label are clustered around the most confident box when
+    their intersection over the smaller box is at least threshold, which also
+    catches objects cut in half at a tile seam. 'nms' keeps the most
+    confident box of a cluster, 'wbf' the confidence weighted average box.
+    """
+    if len(detections) < 2:
+        return detections
+    boxes = np.array([detection[:4] for detection in detections], dtype=np.float64)
+    scores = np.array([detection[4] for detection in detections], dtype=np.float64)
+    labels = [detection[5] for detection in detections]
+    _, label_index = np.unique(labels, return_inverse=True)
+    # Offset each label so boxes of different labels never intersect
+    shifted = boxes + (label_index * 2.0)[:, np.newaxis]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-scores, kind='stable')
+    merged = []
+    while len(order) > 0:
+        first, rest = order[0], order[1:]
+        width = np.minimum(shifted[first, 2], shifted[rest, 2]) - np.maximum(shifted[first, 0], shifted[rest, 0])
+        height = np.minimum(shifted[first, 3], shifted[rest, 3]) - np.maximum(shifted[first, 1], shifted[rest, 1])
+        intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+        overlap = intersection / np.maximum(np.minimum(areas[first], areas[rest]), 1e-12)
+        matched = overlap >= threshold
+        box = boxes[first]
+        if method == 'wbf':
+            cluster = np.concatenate(([first], rest[matched]))
+            weights = scores[cluster]
+            box = (boxes[cluster] * weights[:, np.newaxis]).sum(0) / weights.sum()
+        merged.append(box.tolist() + [float(scores[first]), labels[first]])
+        order = rest[~matched]
+    return merged
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+import os
+import ast
+import argparse
+import torch
+import numpy as np
+import onnxruntime as ort
+from functools import partial
+from bboxee.annotator import yolo_v5
+from bboxee.annotator.registry import registry
+from bboxee.annotator.loaders import load_letterboxed
+from bboxee.annotator.masking import mask_key
+
+
+def load_session(model_file, intra_op_threads=0, inter_op_threads=0):
+    """Create an onnxruntime cpu session, zero threads lets onnxruntime decide."""
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return ort.InferenceSession(model_file, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def load_names(session):
+    """Read the class names stored in the model metadata by the export."""
+    metadata = session.get_modelmeta().custom_metadata_map
+    if 'names' not in metadata:
+        raise ValueError('Model has no class names, export it with the bboxee, YOLOv5 or Ultralytics export.')
+    names = ast.literal_eval(metadata['names'])
+    return dict(enumerate(names)) if isinstance(names, list) else names
+
+
+def to_yolov5_layout(pred, classes):
+    """Convert Ultralytics (YOLOv8 / YOLOv9) output, boxes and class scores
+    without objectness, to the YOLOv5 layout expected by the NMS."""
+    if pred.shape[1] != classes + 4:
+        return pred
+    pred = pred.transpose(0, 2, 1)
+    objectness = np.ones(pred.shape[:2] + (1,), dtype=pred.dtype)
+    return np.concatenate((pred[..., :4], objectness, pred[..., 4:]), axis=2)
+
+
+def export(model_file, output_file=None, image_size=640, opset=12):
+    """Export a YOLOv5 .pt checkpoint to .onnx with dynamic batch and
+    image dimensions, class names are stored in the model metadata."""
+    import onnx
+    from yolov5.models.yolo import Detect
+    if output_file is None:
+        output_file = os.path.splitext(model_file)[0] + '.onnx'
+    model = yolo_v5.load_model(model_file, 'cpu')
+    for m in model.modules():
+        if isinstance(m, Detect):
+            m.inplace = False
+            m.dynamic = True
+            m.export = True
+    stride = int(max(model.stride))
+    sample = torch.zeros(1, 3, image_size, image_size)
+    model(sample)  # dry run to build the anchor grids
+    torch.onnx.export(model, sample, output_file,
+                      opset_version=opset,
+                      do_constant_folding=True,
+                      input_names=['images'],
+                      output_names=['output0'],
+                      dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},
+                                    'output0': {0: 'batch', 1: 'anchors'}})
+    model_onnx = onnx.load(output_file)
+    for key, value in {'stride': stride, 'names': model.names}.items():
+        meta = model_onnx.metadata_props.add()
+        meta.key, meta.value = key, str(value)
+    onnx.save(model_onnx, output_file)
+    return output_file
+
+
+class Annotator(yolo_v5.Annotator):
+    """YOLO annotator running an exported .onnx model with onnxruntime.
+
+    Images are letterboxed and detections pass through the same NMS as the
+    PyTorch annotator, so the annotations are interchangeable. The model can
+    also be a YOLOv5 or YOLOv9 (family) checkpoint, which is exported and
+    optionally quantized to INT8 (quantization 'dynamic' or 'static').
+    """
+
+    def __init__(self, model_file, image_size, stride, batch_size=1, reduced_decode=False,
+                 intra_op_threads=0, inter_op_threads=0):
+        """Class init function."""
+        yolo_v5.Annotator.__init__(self, model_file, image_size, stride, batch_size, reduced_decode)
+        self.device = 'cpu'
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.family = 'yolov5'
+        self.quantization = None
+        self.calibration_images = 32
+
+    def infer(self, images):
+        """Pass a uint8 NCHW batch through the session."""
+        img = images.astype(np.float32)
+        img /= 255
+        pred = self.model.run(None, {self.model.get_inputs()[0].name: img})[0]
+        return torch.from_numpy(to_yolov5_layout(pred, len(self.names)))
+
+    def get_model(self):
+        """Get the session from the registry, creating it on first use.
+
+        Checkpoints are exported to ONNX next to the checkpoint first and,
+        when quantization is set, quantized to INT8 using a sample of the
+        images being annotated for calibration.
+        """
+        model_file = self.model_file
+        if self.quantization is not None:
+            from bboxee.annotator.quantize import quantize, sample
+            files = [os.path.join(self.image_directory, image_name) for image_name in self.image_list]
+            function = partial(load_letterboxed, image_size=self.image_size, stride=self.stride,
+                               reduced_decode=self.reduced_decode, mask=self.mask)
+            model_file = quantize(model_file, self.quantization, sample(files, self.calibration_images), function, self.family, self.image_size)
+        elif not model_file.endswith('.onnx'):
+            from bboxee.annotator.quantize import fp32_file
+            model_file = fp32_file(model_file, self.family, self.image_size)
+        device = 'cpu/{}/{}'.format(self.intra_op_threads, self.inter_op_threads)
+        loader = partial(load_session, model_file, self.intra_op_threads, self.inter_op_threads)
+        model = registry.get('onnx', model_file, device, loader)
+        self.names = load_names(model)
+        return model
+
+    def input_key(self):
+        """Describe the preprocessing that detections depend on."""
+        key = 'onnx/{}/{}/{}/{}'.format(self.image_size, self.stride, int(self.reduced_decode), self.quantization or 'fp32')
+        return key + self.tile_key() + self.refine_key() + mask_key(self.mask)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a YOLOv5 checkpoint to ONNX.')
+    parser.add_argument('model', help='YOLOv5 .pt checkpoint')
+    parser.add_argument('--output', help='output file, defaults to the checkpoint name with .onnx')
+    parser.add_argument('--image-size', type=int, default=640, help='image size used to trace the model')
+    parser.add_argument('--opset', type=int, default=12, help='ONNX opset version')
+    args = parser.parse_args()
+    print(export(args.model, args.output, args.image_size, args.opset))
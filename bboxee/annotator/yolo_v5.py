@@ -23,13 +23,68 @@
 #
 # --------------------------------------------------------------------------
 import os
+import sys
+import math
+import time
+import hashlib
 import torch
+import yolov5
+import torchvision
 import numpy as np
 from PIL import Image
+from functools import partial
 from PyQt6 import QtCore
-from bboxee import schema
-from yolov5.utils.augmentations import letterbox
-from yolov5.utils.general import non_max_suppression, scale_boxes, xyxy2xywh
+from bboxee.annotator.pipeline import Throughput, bucket, prefetch, shared_prefetch
+from bboxee.annotator.registry import registry
+from bboxee.annotator.detections import DetectionStore
+from bboxee.annotator.loaders import decoded_size, letterbox_shape, load_letterboxed, load_tiles
+from bboxee.annotator.masking import mask_key, mask_window, scale_mask
+from bboxee.annotator.tiling import merge, place, tile_windows
+from bboxee.annotator.detection_cache import cache_directory
+from bboxee.annotator.runs import emit_detections, emit_screened, finish_run, screened, start_run
+from yolov5.utils.general import non_max_suppression, scale_boxes
+
+
+def prepared_file(model_file):
+    """Cache file for a prepared model, keyed by the checkpoint hash and the
+    Python, torch and yolov5 versions that pickled it. The pickle refers to
+    the yolov5 classes, so an upgraded package prepares the model again."""
+    digest = hashlib.sha1()
+    with open(model_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    name = '{}-py{}.{}-torch{}-yolov5{}.pt'.format(digest.hexdigest(), sys.version_info[0], sys.version_info[1],
+                                                   torch.__version__, getattr(yolov5, '__version__', 'unknown'))
+    return os.path.join(cache_directory(), 'models', name)
+
+
+def load_model(model_file, device):
+    """Load a YOLOv5 checkpoint and prepare it for inference.
+
+    The patched and fused model is pickled to the user cache directory and
+    loaded directly on later runs.
+    """
+    cache_file = prepared_file(model_file)
+    if os.path.exists(cache_file):
+        try:
+            return torch.load(cache_file, map_location='cpu', weights_only=False).to(device)
+        except Exception as error:
+            print('Ignoring prepared model {}: {}'.format(cache_file, error))
+    checkpoint = torch.load(model_file)
+    # Patch for older YOLOv5 models
+    for m in checkpoint['model'].modules():
+        if isinstance(m, torch.nn.Upsample) and not hasattr(m, 'recompute_scale_factor'):
+            m.recompute_scale_factor = None
+    model = checkpoint['model'].float().fuse().eval()
+    try:
+        # Write to a temporary file first so other processes never see a partial model
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        temporary = '{}.{}.tmp'.format(cache_file, os.getpid())
+        torch.save(model, temporary)
+        os.replace(temporary, cache_file)
+    except OSError as error:
+        print('Could not cache prepared model: {}'.format(error))
+    return model.to(device)
 
 
 class Annotator(QtCore.QThread):
@@ -39,7 +94,7 @@ class Annotator(QtCore.QThread):
     finished = QtCore.pyqtSignal(dict)
     model_loaded = QtCore.pyqtSignal()
 
-    def __init__(self, model_file, image_size, stride):
+    def __init__(self, model_file, image_size, stride, batch_size=1, reduced_decode=False):
         """Class init function."""
         QtCore.QThread.__init__(self)
         self.stop = False
@@ -49,9 +104,40 @@ class Annotator(QtCore.QThread):
         self.image_directory = ''
         self.data = None
         self.model = None
+        self.names = {}
         self.model_file = model_file
         self.image_size = image_size
         self.stride = stride
+        self.batch_size = max(1, batch_size)
+        self.reduced_decode = reduced_decode
+        self.prefetch_workers = 2
+        self.prefetch_depth = 8
+        self.decode_processes = 0
+        self.ring_slots = 16
+        self.stats = None
+        self.cache = None
+        self.detection_floor = 0.05
+        self.store = DetectionStore()
+        self.fingerprint = ''
+        self.floor = self.threshold
+        self.tile_size = 0
+        self.tile_overlap = 0.2
+        self.tile_full_frame = False
+        self.tile_merge = 'nms'
+        self.mask = None
+        self.prescreen = None
+        self.dedup = None
+        self.refine_size = 0
+        self.refine_band = (0.2, 0.6)
+        self.refine_area = 0.001
+        self.refined = 0
+        self.bucket_span = 256
+        self.queue = []
+        self.cached = {}
+        self.skipped = set()
+        self.followers = {}
+        self.ready = {}
+        self.position = 0
         self.device = 'cpu'
         if torch.cuda.is_available():
             self.device = 'cuda:0'
@@ -61,68 +147,246 @@ class Annotator(QtCore.QThread):
         except AttributeError:
             pass
 
+    def detect(self, batch):
+        """Pass a batch of letterboxed images through the model and emit the
+        detections for each image in the order they were queued."""
+        start = time.perf_counter()
+        if len(batch) == 1:
+            images = batch[0][3][np.newaxis]
+        else:
+            images = np.stack([item[3] for item in batch])
+        pred = non_max_suppression(prediction=self.infer(images), conf_thres=self.floor)
+        if self.stats is not None:
+            self.stats.add('inference', time.perf_counter() - start, len(batch))
+        results = []
+        for (_, _, original_shape, _, window), det in zip(batch, pred):
+            results.append(self.raw_detections(det, images.shape[2:], original_shape, window))
+        if self.refine_size > 0:
+            self.refine(batch, results)
+        for item, detections in zip(batch, results):
+            self.deliver(item[0], item[1], detections)
+
+    def raw_detections(self, det, input_shape, original_shape, window):
+        """Rescale the boxes of one image to the window and normalize them to
+        the full image, newest first."""
+        detections = []
+        if len(det):
+            x0, y0, x1, y1 = window
+            det[:, :4] = scale_boxes(input_shape, det[:, :4], (y1 - y0, x1 - x0)).round()
+            det = det.flip(0)
+            boxes = place(det[:, :4].numpy(), window, original_shape[1], original_shape[0]).tolist()
+            confidences = det[:, 4].tolist()
+            classes = det[:, 5].int().tolist()
+            for box, conf, cls in zip(boxes, confidences, classes):
+                detections.append(box + [conf, self.names[cls]])
+        return detections
+
+    def uncertain(self, detections):
+        """True when a detection falls in the refine confidence band, or is
+        small and at least as confident as the band."""
+        low, high = self.refine_band
+        for xmin, ymin, xmax, ymax, conf, _ in detections:
+            if low <= conf < high:
+                return True
+            if conf >= low and (xmax - xmin) * (ymax - ymin) < self.refine_area:
+                return True
+        return False
+
+    def combine(self, detections, iou_thres=0.45):
+        """Per class IoU non maximum suppression, at the threshold used within
+        a pass, over the detections of both passes of a refined image. Unlike
+        the seam merge it keeps nested and touching animals of one class."""
+        if len(detections) == 0:
+            return detections
+        labels = {}
+        boxes = torch.tensor([detection[:4] for detection in detections])
+        scores = torch.tensor([detection[4] for detection in detections])
+        classes = torch.tensor([labels.setdefault(detection[5], len(labels)) for detection in detections])
+        keep = torchvision.ops.batched_nms(boxes, scores, classes, iou_thres)
+        return [detections[index] for index in keep.tolist()]
+
+    def refine(self, batch, results):
+        """Run the images with uncertain detections again at refine_size and
+        merge the detections of both passes."""
+        for index, (_, image_name, _, _, _) in enumerate(batch):
+            if not self.uncertain(results[index]):
+                continue
+            start = time.perf_counter()
+            file_name = os.path.join(self.image_directory, image_name)
+            prepared = load_letterboxed(file_name, self.refine_size, self.stride, self.reduced_decode, self.mask)
+            if prepared is None:
+                continue
+            (original_shape, window), img = prepared
+            det = non_max_suppression(prediction=self.infer(img[np.newaxis]), conf_thres=self.floor)[0]
+            fine = self.raw_detections(det, img.shape[1:], original_shape, window)
+            results[index] = self.combine(results[index] + fine)
+            self.refined += 1
+            if self.stats is not None:
+                self.stats.add('refine', time.perf_counter() - start)
+
+    def detect_tiles(self, count, image_name, original_shape, window, tiles):
+        """Pass the tiles of an image through the model as one batch, shift
+        the boxes back to the full image and merge duplicates across seams."""
+        start = time.perf_counter()
+        pred = non_max_suppression(prediction=self.infer(tiles), conf_thres=self.floor)
+        if self.stats is not None:
+            self.stats.add('inference', time.perf_counter() - start)
+        height, width = original_shape[:2]
+        left, top, right, bottom = window
+        windows = tile_windows(right - left, bottom - top, self.tile_size, self.tile_overlap, self.tile_full_frame)
+        detections = []
+        for (x0, y0, x1, y1), det in zip(windows, pred):
+            if len(det):
+                det[:, :4] = scale_boxes(tiles.shape[2:], det[:, :4], (y1 - y0, x1 - x0)).round()
+                boxes = place(det[:, :4].numpy(), (left + x0, top + y0), width, height).tolist()
+                for box, conf, cls in zip(boxes, det[:, 4].tolist(), det[:, 5].int().tolist()):
+                    detections.append(box + [conf, self.names[cls]])
+        self.deliver(count, image_name, merge(detections, method=self.tile_merge))
+
+    def infer(self, images):
+        """Pass a uint8 NCHW batch through the model, returns the raw
+        predictions as a tensor on the cpu."""
+        img = torch.from_numpy(images).to(self.device).float()
+        img /= 255
+        return self.model(img)[0].cpu()
+
+    def get_model(self):
+        """Get the model from the registry, loading it on first use."""
+        loader = partial(load_model, self.model_file, self.device)
+        model = registry.get('yolov5', self.model_file, self.device, loader)
+        self.names = model.names
+        return model
+
+    def emit(self, count, image_name, detections, cached=False, created_by='machine'):
+        """Cache the raw detections of an image and emit those above threshold."""
+        emit_detections(self, count, image_name, detections, cached, created_by)
+
+    def deliver(self, count, image_name, detections):
+        """Hold the detections of a queued image until every image before it
+        has been emitted, None marks an image that could not be read."""
+        self.ready[count] = detections
+        self.release()
+
+    def release(self):
+        """Emit the held, cached, likely empty and duplicate images at the
+        front of the queue, stopping at the first image still being detected."""
+        while self.position < len(self.queue):
+            count, image_name = self.queue[self.position]
+            if screened(self, image_name):
+                emit_screened(self, count, image_name)
+            elif count in self.ready:
+                detections = self.ready.pop(count)
+                if detections is not None:
+                    self.emit(count, image_name, detections)
+            else:
+                break
+            self.position += 1
+
+    def schedule(self, misses):
+        """Reorder misses so images with the same letterboxed shape are
+        batched together. Only the image headers are read."""
+        files = [os.path.join(self.image_directory, image_name) for _, image_name in misses]
+        function = partial(decoded_size, image_size=self.image_size, reduced_decode=self.reduced_decode)
+        windows = {}
+        shapes = []
+        for _, size in prefetch(function, files, self.prefetch_workers, self.prefetch_depth):
+            if size is None:
+                shapes.append(None)
+                continue
+            if size not in windows:
+                width, height = size
+                window = None if self.mask is None else mask_window(scale_mask(self.mask, width, height))
+                windows[size] = window or (0, 0, width, height)
+            x0, y0, x1, y1 = windows[size]
+            shapes.append(letterbox_shape(x1 - x0, y1 - y0, self.image_size, self.stride))
+        return bucket(misses, shapes, self.bucket_span)
+
+    def input_key(self):
+        """Describe the preprocessing that detections depend on."""
+        key = 'yolov5/{}/{}/{}'.format(self.image_size, self.stride, int(self.reduced_decode))
+        return key + self.tile_key() + self.refine_key() + mask_key(self.mask)
+
+    def tile_key(self):
+        """Describe the tiling that detections depend on."""
+        if self.tile_size == 0:
+            return ''
+        return '/tiles/{}/{}/{}/{}'.format(self.tile_size, self.tile_overlap, int(self.tile_full_frame), self.tile_merge)
+
+    def refine_key(self):
+        """Describe the second pass that detections depend on."""
+        if self.refine_size == 0 or self.tile_size > 0:
+            return ''
+        # Passes are merged with IoU NMS, older caches used the seam merge
+        return '/refine/{}/{}/{}/{}/nms'.format(self.refine_size, self.refine_band[0], self.refine_band[1], self.refine_area)
+
     def run(self):
         """The starting point for the thread."""
-        self.stop = False
-        self.data = schema.annotation_file()
-        self.data['analysts'].append('Machine Generated')
-
-        if self.model is None:
-            checkpoint = torch.load(self.model_file)
-            # Patch for older YOLOv5 models
-            for m in checkpoint['model'].modules():
-                if isinstance(m, torch.nn.Upsample) and not hasattr(m, 'recompute_scale_factor'):
-                    m.recompute_scale_factor = None
-            self.model = checkpoint['model'].float().fuse().eval().to(self.device)
-
-        self.model_loaded.emit()
-        for count, image_name in enumerate(self.image_list):
-            if count >= self.starting_image:
+        self.refined = 0
+        self.queue, misses = start_run(self, self.model_file)
+        try:
+            # Everything else is emitted in queue order as the misses are detected
+            self.ready = {}
+            self.position = 0
+            if self.bucket_span > 0 and self.batch_size > 1 and self.tile_size == 0:
+                misses = self.schedule(misses)
+
+            if len(misses) > 0:
+                self.model = self.get_model()
+
+            self.model_loaded.emit()
+            files = [os.path.join(self.image_directory, image_name) for _, image_name in misses]
+            function = partial(load_letterboxed, image_size=self.image_size, stride=self.stride,
+                               reduced_decode=self.reduced_decode, mask=self.mask)
+            hold = self.batch_size
+            if self.tile_size > 0:
+                function = partial(load_tiles, image_size=self.image_size, stride=self.stride, tile_size=self.tile_size,
+                                   overlap=self.tile_overlap, full_frame=self.tile_full_frame, mask=self.mask)
+                hold = 1
+            if self.decode_processes > 0:
+                # Letterboxed images are never larger than the stride aligned image size
+                side = math.ceil(self.image_size / self.stride) * self.stride
+                slot_size = side * side * 3
+                if self.tile_size > 0:
+                    # Room for all tiles of an image the size of the first one
+                    first = next((f for f in files if os.path.exists(f)), None)
+                    if first is not None:
+                        with Image.open(first) as image:
+                            width, height = image.size
+                        slot_size *= len(tile_windows(width, height, self.tile_size, self.tile_overlap, self.tile_full_frame))
+                self.stats = Throughput()
+                images = shared_prefetch(function, files, slot_size, self.decode_processes, self.ring_slots, hold, self.stats)
+            else:
+                images = prefetch(function, files, self.prefetch_workers, self.prefetch_depth)
+            batch = []
+            for count, image_name in misses:
                 if self.stop:
                     break
-                file_name = os.path.join(self.image_directory, image_name)
-                if os.path.exists(file_name):
-                    image = Image.open(file_name)
-                    img_original = np.asarray(image)
-                    image.close()
-                    # padded resize
-                    img = letterbox(img_original, new_shape=self.image_size, stride=self.stride, auto=True)[0]  # JIT requires auto=False
-                    img = img.transpose((2, 0, 1))  # HWC to CHW; PIL Image is RGB already
-                    img = np.ascontiguousarray(img)
-                    img = torch.from_numpy(img)
-                    img = img.float()
-                    img /= 255
-                    img = torch.unsqueeze(img, 0).to(self.device)
-                    pred: list = self.model(img)[0]
-                    pred = non_max_suppression(prediction=pred.cpu(), conf_thres=self.threshold)
-                    gn = torch.tensor(img_original.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-
-                    entry = schema.annotation_file_entry()
-                    for det in pred:
-                        if len(det):
-                            # Rescale boxes
-                            det[:, :4] = scale_boxes(img.shape[2:], det[:, :4], img_original.shape).round()
-                            for *box, conf, cls in reversed(det):
-                                annotation = schema.annotation()
-                                annotation['created_by'] = 'machine'
-                                # normalized center-x, center-y, width and height
-                                bbox = (xyxy2xywh(torch.tensor(box).view(1, 4)) / gn).view(-1).tolist()
-                                x_center, y_center, width_of_box, height_of_box = bbox
-                                x_min = x_center - width_of_box / 2.0
-                                y_min = y_center - height_of_box / 2.0
-                                x_max = x_center + width_of_box / 2.0
-                                y_max = y_center + height_of_box / 2.0
-                                annotation['bbox']['xmin'] = x_min
-                                annotation['bbox']['xmax'] = x_max
-                                annotation['bbox']['ymin'] = y_min
-                                annotation['bbox']['ymax'] = y_max
-                                annotation['label'] = self.model.names[int(cls.item())]
-                                annotation['confidence'] = conf.item()
-                                entry['annotations'].append(annotation)
-                    if len(entry['annotations']) > 0:
-                        self.data['images'][image_name] = entry
-                    self.progress.emit(count + 1, image_name, entry)
-        self.finished.emit(self.data)
+                _, prepared = next(images)
+                if prepared is None:
+                    self.deliver(count, image_name, None)
+                    continue
+                (original_shape, window), img = prepared
+                if self.tile_size > 0:
+                    self.detect_tiles(count, image_name, original_shape, window, img)
+                    continue
+                # Images can only be stacked with others of the same padded shape
+                if len(batch) > 0 and batch[0][3].shape != img.shape:
+                    self.detect(batch)
+                    batch = []
+                batch.append((count, image_name, original_shape, img, window))
+                if len(batch) == self.batch_size:
+                    self.detect(batch)
+                    batch = []
+            if len(batch) > 0 and not self.stop:
+                self.detect(batch)
+            if not self.stop:
+                self.release()
+            images.close()
+            if self.refine_size > 0 and self.tile_size == 0:
+                print('Refined {} of {} images at {}'.format(self.refined, len(misses), self.refine_size))
+        finally:
+            # Also on errors, so the detections cached so far are committed
+            finish_run(self)
 
     def stop_annotation(self):
         self.stop = True
@@ -23,9 +23,17 @@
 #
 # --------------------------------------------------------------------------
 import os
+import time
 import torch
+from functools import partial
 from PyQt6 import QtCore
-from bboxee import schema
+from bboxee.annotator.pipeline import Throughput, image_bytes, prefetch, shared_prefetch
+from bboxee.annotator.registry import registry
+from bboxee.annotator.detections import DetectionStore
+from bboxee.annotator.loaders import load_bgr
+from bboxee.annotator.masking import mask_key
+from bboxee.annotator.tiling import merge, place, tile_windows
+from bboxee.annotator.runs import emit_detections, emit_screened, finish_run, screened, start_run
 from ultralytics import YOLO
 
 
@@ -36,7 +44,7 @@ class Annotator(QtCore.QThread):
     finished = QtCore.pyqtSignal(dict)
     model_loaded = QtCore.pyqtSignal()
 
-    def __init__(self, model_file):
+    def __init__(self, model_file, batch_size=1, streaming=False):
         """Class init function."""
         QtCore.QThread.__init__(self)
         self.stop = False
@@ -47,6 +55,28 @@ class Annotator(QtCore.QThread):
         self.data = None
         self.model = None
         self.model_file = model_file
+        self.batch_size = max(1, batch_size)
+        self.streaming = streaming
+        self.prefetch_workers = 2
+        self.prefetch_depth = 8
+        self.decode_processes = 0
+        self.ring_slots = 16
+        self.stats = None
+        self.cache = None
+        self.detection_floor = 0.05
+        self.store = DetectionStore()
+        self.fingerprint = ''
+        self.floor = self.threshold
+        self.tile_size = 0
+        self.tile_overlap = 0.2
+        self.tile_full_frame = False
+        self.tile_merge = 'nms'
+        self.mask = None
+        self.prescreen = None
+        self.dedup = None
+        self.cached = {}
+        self.skipped = set()
+        self.followers = {}
         self.device = 'cpu'
         if torch.cuda.is_available():
             self.device = 'cuda:0'
@@ -56,40 +86,114 @@ class Annotator(QtCore.QThread):
         except AttributeError:
             pass
 
+    def detect(self, batch):
+        """Pass a batch of images through the model and emit the detections
+        for each image in the order they were queued."""
+        start = time.perf_counter()
+        # The predictor keeps detections down to the floor, not the default
+        # conf of 0.25, and per image logging is turned off
+        if self.streaming:
+            # One predictor call per batch
+            results = list(self.model.predict(source=[item[2] for item in batch],
+                                              stream=True,
+                                              conf=self.floor,
+                                              batch=len(batch),
+                                              verbose=False))
+        else:
+            results = self.model(batch[0][2], conf=self.floor, verbose=False)
+        if self.stats is not None:
+            self.stats.add('inference', time.perf_counter() - start, len(batch))
+        for (count, image_name, _, (original_shape, window)), result in zip(batch, results):
+            boxes = result.boxes.cpu()
+            detections = []
+            classes = boxes.cls.int().tolist()
+            # Boxes are in pixels of the window, normalize them to the full image
+            xyxyn = place(boxes.xyxy.numpy(), window, original_shape[1], original_shape[0]).tolist()
+            for box, conf, cls in zip(xyxyn, boxes.conf.tolist(), classes):
+                detections.append(box + [conf, self.model.names[cls]])
+            self.emit(count, image_name, detections)
+
+    def detect_tiles(self, count, image_name, image, region):
+        """Pass the tiles of an image through the model as one batch, shift
+        the boxes back to the full image and merge duplicates across seams."""
+        original_shape, (left, top, _, _) = region
+        height, width = original_shape[:2]
+        windows = tile_windows(image.shape[1], image.shape[0], self.tile_size, self.tile_overlap, self.tile_full_frame)
+        start = time.perf_counter()
+        results = list(self.model.predict(source=[image[y0:y1, x0:x1] for x0, y0, x1, y1 in windows],
+                                          stream=True,
+                                          conf=self.floor,
+                                          batch=len(windows),
+                                          verbose=False))
+        if self.stats is not None:
+            self.stats.add('inference', time.perf_counter() - start)
+        detections = []
+        for (x0, y0, _, _), result in zip(windows, results):
+            boxes = result.boxes.cpu()
+            classes = boxes.cls.int().tolist()
+            xyxyn = place(boxes.xyxy.numpy(), (left + x0, top + y0), width, height).tolist()
+            for box, conf, cls in zip(xyxyn, boxes.conf.tolist(), classes):
+                detections.append(box + [conf, self.model.names[cls]])
+        self.emit(count, image_name, merge(detections, method=self.tile_merge))
+
+    def emit(self, count, image_name, detections, cached=False, created_by='machine'):
+        """Cache the raw detections of an image and emit those above threshold."""
+        emit_detections(self, count, image_name, detections, cached, created_by)
+
+    def input_key(self):
+        """Describe the preprocessing that detections depend on."""
+        key = 'yolov9'
+        if self.tile_size > 0:
+            key += '/tiles/{}/{}/{}/{}'.format(self.tile_size, self.tile_overlap, int(self.tile_full_frame), self.tile_merge)
+        return key + mask_key(self.mask)
+
     def run(self):
         """The starting point for the thread."""
-        self.stop = False
-        self.data = schema.annotation_file()
-        self.data['analysts'].append('Machine Generated')
-
-        if self.model is None:
-            self.model = YOLO(self.model_file)
+        queue, misses = start_run(self, self.model_file)
+        try:
+            if len(misses) > 0:
+                self.model = registry.get('yolov9', self.model_file, self.device, lambda: YOLO(self.model_file))
 
-        self.model_loaded.emit()
-        for count, image_name in enumerate(self.image_list):
-            if count >= self.starting_image:
+            self.model_loaded.emit()
+            files = [os.path.join(self.image_directory, image_name) for _, image_name in misses]
+            function = partial(load_bgr, mask=self.mask)
+            if self.decode_processes > 0:
+                # Slots are sized to the first image, larger images are copied
+                first = next((f for f in files if os.path.exists(f)), None)
+                slot_size = image_bytes(first) if first is not None else 1
+                self.stats = Throughput()
+                hold = self.batch_size if self.streaming and self.tile_size == 0 else 1
+                images = shared_prefetch(function, files, slot_size, self.decode_processes, self.ring_slots, hold, self.stats)
+            else:
+                images = prefetch(function, files, self.prefetch_workers, self.prefetch_depth)
+            batch = []
+            for count, image_name in queue:
                 if self.stop:
                     break
-                file_name = os.path.join(self.image_directory, image_name)
-                if os.path.exists(file_name):
-                    results = self.model(file_name)
-                    boxes = results[0].boxes.cpu()
-                    entry = schema.annotation_file_entry()
-                    for index, conf in enumerate(boxes.conf):
-                        if conf >= self.threshold:
-                            annotation = schema.annotation()
-                            annotation['created_by'] = 'machine'
-                            annotation['bbox']['xmin'] = boxes.xyxyn[index][0].item()
-                            annotation['bbox']['ymin'] = boxes.xyxyn[index][1].item()
-                            annotation['bbox']['xmax'] = boxes.xyxyn[index][2].item()
-                            annotation['bbox']['ymax'] = boxes.xyxyn[index][3].item()
-                            annotation['label'] = self.model.names[int(boxes.cls[index])]
-                            annotation['confidence'] = conf.item()
-                            entry['annotations'].append(annotation)
-                    if len(entry['annotations']) > 0:
-                        self.data['images'][image_name] = entry
-                    self.progress.emit(count + 1, image_name, entry)
-        self.finished.emit(self.data)
+                if screened(self, image_name):
+                    # Cached, likely empty and duplicate frames skip inference,
+                    # flush queued images first to keep the progress in order
+                    if len(batch) > 0:
+                        self.detect(batch)
+                        batch = []
+                    emit_screened(self, count, image_name)
+                    continue
+                _, prepared = next(images)
+                if prepared is not None:
+                    region, image = prepared
+                    if self.tile_size > 0:
+                        self.detect_tiles(count, image_name, image, region)
+                        continue
+                    batch.append((count, image_name, image, region))
+                    if len(batch) == self.batch_size or not self.streaming:
+                        self.detect(batch)
+                        batch = []
+            if len(batch) > 0 and not self.stop:
+                self.detect(batch)
+            images.close()
+        finally:
+            # Also on errors, so the detections cached so far are committed
+            finish_run(self)
 
     def stop_annotation(self):
         self.stop = True
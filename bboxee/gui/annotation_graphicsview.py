@@ -526,7 +526,7 @@ class AnnotationGraphicsView(QtWidgets.QGraphicsView):
             label = annotation['label']
         elif annotation is None:
             color = QtCore.Qt.GlobalColor.green
-        elif annotation['created_by'] == 'machine' and annotation['updated_by'] == '':
+        elif annotation['created_by'] in ('machine', 'propagated') and annotation['updated_by'] == '':
             color = QtCore.Qt.GlobalColor.magenta
         else:
             color = QtCore.Qt.GlobalColor.yellow
@@ -25,11 +25,13 @@
 import os
 import sys
 import glob
+import time
 import json
 import numpy as np
 from PIL import Image
 from PyQt6 import QtCore, QtGui, QtWidgets, uic
 from bboxee import schema
+from bboxee.annotator.detections import refilter_entry
 from bboxee.gui import SelectModelDialog
 from bboxee.gui import AnalystDialog
 from bboxee.gui import FilterDialog
@@ -67,6 +69,13 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
         self.qt_image = None
 
         self.annotator = None
+        self.detections = None
+        self.pending = {}
+        self.pending_progress = 0
+        self.last_progress = 0.0
+        self.last_preview = 0.0
+        self.progress_interval = 0.2
+        self.preview_interval = 2.0
         self.model_selector = SelectModelDialog(self)
         self.model_selector.selected.connect(self.annotator_selected)
 
@@ -143,6 +152,7 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
 
         self.pb_annotater.clicked.connect(self.select_annotator)
         self.pb_annotate.clicked.connect(self.annotate)
+        self.doubleSpinBoxThreshold.valueChanged.connect(self.rethreshold)
         self.pb_save.clicked.connect(self.save)
         self.pb_mask.clicked.connect(self.select_mask)
         self.lineEditCurrentImage.editingFinished.connect(self.jump_to_image)
@@ -309,9 +319,14 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
             self.progressBar.setFormat("Loading Model...")
             self.progressBar.setRange(0, len(self.image_list))
             self.progressBar.setValue(0)
+            self.pending = {}
+            self.last_progress = 0.0
+            self.last_preview = time.monotonic()
             self.annotator.threshold = self.doubleSpinBoxThreshold.value()
             self.annotator.image_directory = self.image_directory
             self.annotator.image_list = self.image_list
+            # Annotators crop frames to the unmasked window
+            self.annotator.mask = None if self.mask is None else np.ascontiguousarray(self.mask[:, :, 0])
             if self.cb_start_and_merge.isChecked():
                 self.annotator.starting_image = self.current_image - 1
             else:
@@ -324,6 +339,12 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
         if not self.cb_start_and_merge.isChecked():
             self.data.clear()
             self.data.update(data)
+        else:
+            self.data['images'].update(self.pending)
+        if self.pending:
+            self.progressBar.setValue(self.pending_progress)
+        self.pending = {}
+        self.detections = self.annotator.store
         self.display_analysts()
         self.license.setEnabled(True)
         self.analysts.setEnabled(True)
@@ -339,6 +360,20 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
     def annotation_progress(self, progress, image, annotations):
         """(SLOT) Show progress and current detections (annotations) as
         they are processed."""
+        if self.cb_fast_annotate.isChecked():
+            # Collect results and only touch the gui a few times a second
+            self.pending[image] = annotations
+            self.pending_progress = progress
+            now = time.monotonic()
+            if now - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = now
+            self.data['images'].update(self.pending)
+            self.pending = {}
+            self.progressBar.setValue(progress)
+            if now - self.last_preview < self.preview_interval:
+                return
+            self.last_preview = now
         if progress - 1 != self.current_image:
             self.current_image = progress - 1
         self.progressBar.setValue(progress)
@@ -448,6 +483,9 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
         self.tw_labels.selectionModel().blockSignals(False)
         self.tw_labels.clearSelection()
         if 'images' in self.data and self.current_file_name in self.data['images']:  # Check
+            if self.detections is not None:
+                for annotation in self.data['images'][self.current_file_name]['annotations']:
+                    self.detections.delete(self.current_file_name, annotation)
             del self.data['images'][self.current_file_name]
         self.graphicsView.sticky_bbox = False
         self.graphicsView.selected_bbox = None
@@ -469,7 +507,9 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
         """Delete row from table and associated metadata."""
         self.tw_labels.selectionModel().blockSignals(True)
         self.tw_labels.removeRow(row)
-        del self.data['images'][self.current_file_name]['annotations'][row]
+        annotation = self.data['images'][self.current_file_name]['annotations'].pop(row)
+        if self.detections is not None:
+            self.detections.delete(self.current_file_name, annotation)
         if self.tw_labels.rowCount() == 0:
             del self.data['images'][self.current_file_name]
             self.graphicsView.setFocus()
@@ -742,6 +782,7 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
                 # Generate an empty version of the schema
                 self.data.clear()
                 self.data.update(schema.annotation_file())
+                self.detections = None
                 self.mask = None
 
                 # Update UI
@@ -766,6 +807,7 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
                 self.data.clear()
                 self.data.update(json.load(file))
                 file.close()
+                self.detections = None
 
                 # Search for first instance of config file and load the labels
                 self.image_directory = os.path.split(file_name)[0]
@@ -908,6 +950,28 @@ class AnnotationWidget(QtWidgets.QWidget, WIDGET):
         self.tw_labels.selectRow((self.selected_row - 1) % self.tw_labels.rowCount())
         self.graphicsView.sticky_bbox = True
 
+    def rethreshold(self, threshold):
+        """(SLOT) Filter the detections of the last run at a new threshold
+        without running the model again."""
+        if self.detections is None or len(self.detections) == 0:
+            return
+        if self.annotator is not None and self.annotator.isRunning():
+            return
+        for image_name, detections in self.detections.select(threshold).items():
+            created_by = 'propagated' if image_name in self.detections.propagated else 'machine'
+            deleted = self.detections.deleted.get(image_name, [])
+            if image_name in self.data['images']:
+                refilter_entry(self.data['images'][image_name], detections, threshold, created_by=created_by, deleted=deleted)
+            else:
+                entry = refilter_entry(schema.annotation_file_entry(), detections, threshold,
+                                       created_by=created_by, deleted=deleted)
+                if len(entry['annotations']) > 0:
+                    self.data['images'][image_name] = entry
+        self.set_dirty(True)
+        self.selected_row = -1
+        self.display_annotation_data()
+        self.display_bboxes()
+
     def resizeEvent(self, event):
         """Overload resizeEvent to fit image in graphics view."""
         self.graphicsView.resize()
@@ -51,11 +51,13 @@ class SelectModelDialog(QtWidgets.QDialog, DIALOG):
         self.pushButtonTFModel.clicked.connect(self.get_saved_model)
         self.pushButtonYolov5ModelFile.clicked.connect(self.get_yolov5_model)
         self.pushButtonYolov9ModelFile.clicked.connect(self.get_yolov9_model)
+        self.pushButtonOnnxModelFile.clicked.connect(self.get_onnx_model)
         self.model = None
 
         self.pushButtonTFV2.clicked.connect(self.tensorflow_v2_saved_model)
         self.pushButtonYolov5.clicked.connect(self.yolov5_model)
         self.pushButtonYolov9.clicked.connect(self.yolov9_model)
+        self.pushButtonOnnx.clicked.connect(self.onnx_model)
 
     def set_label(self, label, text):
         qfm = QtGui.QFontMetrics(label.font())
@@ -76,7 +78,12 @@ class SelectModelDialog(QtWidgets.QDialog, DIALOG):
             from bboxee.annotator.tensorflow_v2_saved import Annotator
             model = self.labelTFModel.raw_text
             label_map = self.labelLabelMapV2.raw_text
-            self.annotator = Annotator(model, label_map)
+            self.annotator = Annotator(model, label_map, self.spinBoxTFBatchSize.value())
+            self.set_cache()
+            self.set_tiling()
+            self.set_prescreen()
+            self.set_dedup()
+            self.set_decoding()
             self.selected.emit(self.annotator)
             self.hide()
         except ModuleNotFoundError:
@@ -90,9 +97,23 @@ class SelectModelDialog(QtWidgets.QDialog, DIALOG):
         """Load YOLOv5 Model"""
         self.pushButtonYolov5ModelFile.setDisabled(True)
         try:
-            from bboxee.annotator.yolo_v5 import Annotator
+            if self.quantization() is None:
+                from bboxee.annotator.yolo_v5 import Annotator
+            else:
+                from bboxee.annotator.yolo_onnx import Annotator
             model = self.labelYolov5ModelFile.raw_text
-            self.annotator = Annotator(model, self.spinBoxImageSize.value(), self.spinBoxStride.value())
+            self.annotator = Annotator(model,
+                                       self.spinBoxImageSize.value(),
+                                       self.spinBoxStride.value(),
+                                       self.spinBoxBatchSize.value(),
+                                       self.checkBoxReducedDecode.isChecked())
+            self.annotator.refine_size = self.spinBoxRefineSize.value()
+            self.set_quantization('yolov5')
+            self.set_cache()
+            self.set_tiling()
+            self.set_prescreen()
+            self.set_dedup()
+            self.set_decoding()
             self.selected.emit(self.annotator)
             self.hide()
         except ModuleNotFoundError:
@@ -100,13 +121,52 @@ class SelectModelDialog(QtWidgets.QDialog, DIALOG):
             QtWidgets.QMessageBox.critical(self, 'Export', message)
         self.pushButtonYolov5ModelFile.setEnabled(True)
 
+    def onnx_model(self):
+        """Load YOLO ONNX Model"""
+        self.pushButtonOnnxModelFile.setDisabled(True)
+        try:
+            from bboxee.annotator.yolo_onnx import Annotator
+            model = self.labelOnnxModelFile.raw_text
+            self.annotator = Annotator(model,
+                                       self.spinBoxOnnxImageSize.value(),
+                                       self.spinBoxOnnxStride.value(),
+                                       self.spinBoxOnnxBatchSize.value(),
+                                       False,
+                                       self.spinBoxOnnxIntraOp.value(),
+                                       self.spinBoxOnnxInterOp.value())
+            self.set_quantization('yolov5')
+            self.set_cache()
+            self.set_tiling()
+            self.set_prescreen()
+            self.set_dedup()
+            self.set_decoding()
+            self.selected.emit(self.annotator)
+            self.hide()
+        except ModuleNotFoundError:
+            message = 'Required ONNX Runtime or YOLOv5 modules not found.'
+            QtWidgets.QMessageBox.critical(self, 'Export', message)
+        self.pushButtonOnnxModelFile.setEnabled(True)
+
     def yolov9_model(self):
         """Load YOLOv9 Model"""
         self.pushButtonYolov9ModelFile.setDisabled(True)
         try:
-            from bboxee.annotator.yolo_v9 import Annotator
             model = self.labelYolov9ModelFile.raw_text
-            self.annotator = Annotator(model)
+            if self.quantization() is None:
+                from bboxee.annotator.yolo_v9 import Annotator
+                self.annotator = Annotator(model,
+                                           self.spinBoxYolov9BatchSize.value(),
+                                           self.checkBoxYolov9Streaming.isChecked())
+            else:
+                # Ultralytics default image size and largest stride
+                from bboxee.annotator.yolo_onnx import Annotator
+                self.annotator = Annotator(model, 640, 32, self.spinBoxYolov9BatchSize.value())
+                self.set_quantization('yolov9')
+            self.set_cache()
+            self.set_tiling()
+            self.set_prescreen()
+            self.set_dedup()
+            self.set_decoding()
             self.selected.emit(self.annotator)
             self.hide()
         except ModuleNotFoundError:
@@ -116,6 +176,39 @@ class SelectModelDialog(QtWidgets.QDialog, DIALOG):
 
     # Helper functions
 
+    def quantization(self):
+        return [None, 'dynamic', 'static'][self.comboBoxQuantization.currentIndex()]
+
+    def set_quantization(self, family):
+        if self.quantization() is not None:
+            self.annotator.family = family
+            self.annotator.quantization = self.quantization()
+
+    def set_tiling(self):
+        self.annotator.tile_size = self.spinBoxTileSize.value()
+        self.annotator.tile_overlap = self.doubleSpinBoxTileOverlap.value()
+        self.annotator.tile_full_frame = self.checkBoxTileFullFrame.isChecked()
+        self.annotator.tile_merge = ['nms', 'wbf'][self.comboBoxTileMerge.currentIndex()]
+
+    def set_cache(self):
+        if self.checkBoxCacheDetections.isChecked():
+            from bboxee.annotator.detection_cache import shared_cache
+            self.annotator.cache = shared_cache()
+
+    def set_prescreen(self):
+        if self.checkBoxPrescreen.isChecked():
+            from bboxee.annotator.prescreen import Prescreen
+            self.annotator.prescreen = Prescreen()
+
+    def set_dedup(self):
+        if self.checkBoxDedup.isChecked():
+            from bboxee.annotator.dedup import Deduplicator
+            self.annotator.dedup = Deduplicator(threshold=self.spinBoxDedupThreshold.value())
+
+    def set_decoding(self):
+        self.annotator.decode_processes = self.spinBoxDecodeProcesses.value()
+        self.annotator.ring_slots = self.spinBoxRingSlots.value()
+
     def get_label_map_2(self):
         file_name = (QtWidgets.
                      QFileDialog.
@@ -149,6 +242,17 @@ class SelectModelDialog(QtWidgets.QDialog, DIALOG):
             self.last_dir = os.path.split(file_name[0])[0]
             self.pushButtonYolov5.setDisabled(False)
 
+    def get_onnx_model(self):
+        file_name = (QtWidgets.
+                     QFileDialog.
+                     getOpenFileName(self,
+                                     'Select ONNX Model',
+                                     self.last_dir, '(*.onnx)'))
+        if file_name[0] != '':
+            self.set_label(self.labelOnnxModelFile, file_name[0])
+            self.last_dir = os.path.split(file_name[0])[0]
+            self.pushButtonOnnx.setDisabled(False)
+
     def get_yolov9_model(self):
         file_name = (QtWidgets.
                      QFileDialog.
@@ -23,26 +23,22 @@
 #
 # --------------------------------------------------------------------------
 import os
-import sys
 import json
+import time
 import ntpath
+import argparse
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
+from functools import partial
+from bbx_writer import BbxWriter
+from lease import LeaseQueue, drain, run_leased
+from pipeline import Throughput, image_bytes, load_or_skip, run_workers, shared_prefetch
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import tensorflow.compat.v1 as tf  # noqa: E402
 
-# Usage check
-if len(sys.argv) != 5:
-    print('USAGE: python3 annotate_frozen.py TOP_FOLDER MODEL LABEL_MAP CONFIDENCE')
-    print('EXAMPLE: python3 annotate_frozen.py ../demo ../models/md_v4.1.0.pb ../models/label_map.pbtxt 0.8')
-    sys.exit()
 FORMATS = [".jpg", ".jpeg", ".png"]
-PATH = sys.argv[1]
-MODEL = sys.argv[2]
-LABEL_MAP = sys.argv[3]
-THRESHOLD = float(sys.argv[4])
 
 
 # Helper functions so bboxee.schema does not have to be in pythonpath
@@ -114,82 +110,177 @@ def build_label_map(file_name):
     return label_map
 
 
-# Find all of the folders containing images
-folders = []
-walk_data = os.walk(PATH)
-for dirpath, dirs, files in walk_data:
-    f = (lambda x: os.path.splitext(x)[1].lower() in FORMATS)
-    image_list = list(filter(f, files))
-    if len(image_list) > 0:
-        folders.append((dirpath, image_list))
+def load_image(file_name):
+    """Read an image into an array."""
+    image = Image.open(file_name)
+    image_np = np.array(image)
+    image.close()
+    return image_np.shape, image_np
 
-# Parse label map
-label_map = build_label_map(LABEL_MAP)
 
+class Detector:
+    """Frozen inference graph and the session it runs in."""
 
-# Create the detection graph and read in model
-detection_graph = tf.Graph()
-graph_def = tf.GraphDef()
-with tf.io.gfile.GFile(MODEL, 'rb') as fid:
-    serialized_graph = fid.read()
-    graph_def.ParseFromString(serialized_graph)
+    def __init__(self, model_file, threads=0):
+        # Create the detection graph and read in model
+        self.graph = tf.Graph()
+        graph_def = tf.GraphDef()
+        with tf.io.gfile.GFile(model_file, 'rb') as fid:
+            serialized_graph = fid.read()
+            graph_def.ParseFromString(serialized_graph)
+        with self.graph.as_default():
+            # Import graph
+            tf.import_graph_def(graph_def, name='')
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads)
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.image_tensor = (self.graph.get_tensor_by_name('image_tensor:0'))
+        self.outputs = [self.graph.get_tensor_by_name('detection_boxes:0'),
+                        self.graph.get_tensor_by_name('detection_scores:0'),
+                        self.graph.get_tensor_by_name('detection_classes:0'),
+                        self.graph.get_tensor_by_name('num_detections:0')]
 
-with detection_graph.as_default():
-    # Import graph
-    tf.import_graph_def(graph_def, name='')
+    def detect(self, image_np, threshold, label_map, stats=None):
+        """Pass one image through the graph and return the annotation file
+        entry of the detections above threshold."""
+        image_np_expanded = np.expand_dims(image_np, axis=0)
+        fd = {self.image_tensor: image_np_expanded}
+        start = time.perf_counter()
+        (boxes, scores, classes, num) = self.sess.run(self.outputs, feed_dict=fd)
+        if stats is not None:
+            stats.add('inference', time.perf_counter() - start)
+        boxes = np.squeeze(boxes)
+        scores = np.squeeze(scores)
+        classes = np.squeeze(classes)
+        entry = annotation_file_entry()
+        for i in range(len(scores)):
+            if scores[i] >= threshold:
+                annotation = annotation_block()
+                annotation['created_by'] = 'machine'
+                annotation['confidence'] = float(scores[i])
+                bbox = boxes[i]
+                annotation['bbox']['xmin'] = float(bbox[1])
+                annotation['bbox']['xmax'] = float(bbox[3])
+                annotation['bbox']['ymin'] = float(bbox[0])
+                annotation['bbox']['ymax'] = float(bbox[2])
+                label = 'unknown'
+                if classes[i] in label_map:
+                    label = label_map[classes[i]]
+                annotation['label'] = label
+                entry['annotations'].append(annotation)
+        return entry
+
+
+def annotate_folder(detector, folder, images, decoded, threshold, label_map, progress, stats=None):
+    """Pass the decoded images of a folder through the detector and write
+    the .bbx file of the folder."""
+    bbx_file_name = '{}{}{}.bbx'.format(folder, os.path.sep, ntpath.split(folder)[1])
+    bbx_data = annotation_file()
+    bbx_data['analysts'].append('Machine Generated')
+    writer = BbxWriter(bbx_file_name)
+
+    # Pass each image through model
+    for img in images:
+        _, decoded_image = next(decoded)
+        if decoded_image is None:
+            # Unreadable frames get an empty line
+            entry = annotation_file_entry()
+        else:
+            entry = detector.detect(decoded_image[1], threshold, label_map, stats)
+        writer.add(img, entry)
+        progress.update(1)
+
+    # Dump annotations
+    writer.compact(bbx_data)
+    return len(images)
+
+
+def start_worker(args):
+    """Load the model of a folder worker with its share of the cpu threads."""
+    return Detector(args.model, args.threads), build_label_map(args.label_map)
+
+
+def worker_folder(model, item, progress, args):
+    """Decode and annotate one (folder, images) work item in a worker."""
+    detector, label_map = model
+    folder, images = item
+    decoded = ((image_name, load_or_skip(load_image, os.path.join(folder, image_name))) for image_name in images)
+    return annotate_folder(detector, folder, images, decoded, args.threshold, label_map, progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(epilog='EXAMPLE: python3 annotate_frozen.py ../demo ../models/md_v4.1.0.pb ../models/label_map.pbtxt 0.8')
+    parser.add_argument('path', metavar='TOP_FOLDER')
+    parser.add_argument('model', metavar='MODEL')
+    parser.add_argument('label_map', metavar='LABEL_MAP')
+    parser.add_argument('threshold', metavar='CONFIDENCE', type=float)
+    parser.add_argument('--processes', type=int, default=0,
+                        help='decode images on N processes through a shared memory ring')
+    parser.add_argument('--slots', type=int, default=16, help='number of images in the shared memory ring')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='annotate folders on N processes that each load the model once')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='TensorFlow intra-op threads per worker, defaults to the cpu count divided by the workers')
+    parser.add_argument('--lease-dir',
+                        help='share the folders with other nodes running against the same lease directory')
+    parser.add_argument('--lease-ttl', type=float, default=300.0,
+                        help='seconds without a heartbeat after which the lease of a crashed node is reclaimed')
+    args = parser.parse_args()
+
+    # Find all of the folders containing images
+    folders = []
+    walk_data = os.walk(args.path)
+    for dirpath, dirs, files in walk_data:
+        f = (lambda x: os.path.splitext(x)[1].lower() in FORMATS)
+        image_list = list(filter(f, files))
+        if len(image_list) > 0:
+            folders.append((dirpath, image_list))
+
+    if args.lease_dir is not None:
+        # Folders are claimed one at a time by the workers of every node
+        args.workers = max(1, args.workers)
+    if args.workers > 0:
+        # Largest folders first so the workers finish at about the same time
+        folders.sort(key=lambda folder: len(folder[1]), reverse=True)
+        args.threads = args.threads or max(1, os.cpu_count() // args.workers)
+        print('Annotating {} folders on {} workers with {} threads each'.format(len(folders), args.workers, args.threads))
+        total = sum(len(images) for _, images in folders)
+        folder_work = partial(worker_folder, args=args)
+        if args.lease_dir is None:
+            run_workers(partial(start_worker, args), folder_work, folders, args.workers, total)
+        else:
+            queue = LeaseQueue(args.lease_dir, args.lease_ttl, args.lease_ttl / 5)
+            folder_work = partial(run_leased, folder_work, queue, args.path)
+            items = {os.path.relpath(folder, args.path): (folder, images) for folder, images in folders}
+            drain(queue, list(items), lambda keys: run_workers(partial(start_worker, args), folder_work,
+                                                               [items[key] for key in keys], args.workers, total))
+        return
+
+    # Parse label map
+    label_map = build_label_map(args.label_map)
+
+    # Decode images in the order they will be consumed
+    files = [os.path.join(folder, image_name) for folder, images in folders for image_name in images]
+    stats = None
+    if args.processes > 0 and len(files) > 0:
+        # Slots are sized to the first image, larger images are copied
+        stats = Throughput()
+        decoded = shared_prefetch(partial(load_or_skip, load_image), files, image_bytes(files[0]), args.processes, args.slots, 1, stats)
+    else:
+        decoded = ((file_name, load_or_skip(load_image, file_name)) for file_name in files)
 
     # Begin processing loop
-    with tf.Session(graph=detection_graph) as sess:
-        image_tensor = (detection_graph.get_tensor_by_name('image_tensor:0'))
-        d_boxes = (detection_graph.get_tensor_by_name('detection_boxes:0'))
-        d_scores = (detection_graph.get_tensor_by_name('detection_scores:0'))
-        d_classes = (detection_graph.get_tensor_by_name('detection_classes:0'))
-        num_detections = (detection_graph.get_tensor_by_name('num_detections:0'))
-
-        # Loop through all of the folder with images and process each image
-        for index, (folder, images) in enumerate(folders):
-            print('Processing folder [{}] ({} of {})'.format(folder, str(index + 1), str(len(folders))))
-            bbx_file_name = '{}{}{}.bbx'.format(folder, os.path.sep, ntpath.split(folder)[1])
-            bbx_data = annotation_file()
-            bbx_data['analysts'].append('Machine Generated')
-
-            # Pass each image through model
-            for i in tqdm(range(len(images))):
-                img = images[i]
-                file_name = os.path.join(folder, img)
-                image = Image.open(file_name)
-                image_np = np.array(image)
-                image_np_expanded = np.expand_dims(image_np, axis=0)
-                image.close()
-                fd = {image_tensor: image_np_expanded}
-                (boxes, scores, classes, num) = sess.run([d_boxes,
-                                                         d_scores,
-                                                         d_classes,
-                                                         num_detections],
-                                                         feed_dict=fd)
-                boxes = np.squeeze(boxes)
-                scores = np.squeeze(scores)
-                classes = np.squeeze(classes)
-                entry = annotation_file_entry()
-                for i in range(len(scores)):
-                    if scores[i] >= THRESHOLD:
-                        annotation = annotation_block()
-                        annotation['created_by'] = 'machine'
-                        annotation['confidence'] = float(scores[i])
-                        bbox = boxes[i]
-                        annotation['bbox']['xmin'] = float(bbox[1])
-                        annotation['bbox']['xmax'] = float(bbox[3])
-                        annotation['bbox']['ymin'] = float(bbox[0])
-                        annotation['bbox']['ymax'] = float(bbox[2])
-                        label = 'unknown'
-                        if classes[i] in label_map:
-                            label = label_map[classes[i]]
-                        annotation['label'] = label
-                        entry['annotations'].append(annotation)
-                if len(entry['annotations']) > 0:
-                    bbx_data['images'][img] = entry
-
-            # Dump annotations
-            bbxfile = open(bbx_file_name, 'w')
-            json.dump(bbx_data, bbxfile)
-            bbxfile.close()
+    detector = Detector(args.model, args.threads)
+
+    # Loop through all of the folder with images and process each image
+    for index, (folder, images) in enumerate(folders):
+        print('Processing folder [{}] ({} of {})'.format(folder, str(index + 1), str(len(folders))))
+        progress = tqdm(total=len(images))
+        annotate_folder(detector, folder, images, decoded, args.threshold, label_map, progress, stats)
+        progress.close()
+    decoded.close()
+    if stats is not None:
+        print(stats.summary())
+
+
+if __name__ == '__main__':
+    main()
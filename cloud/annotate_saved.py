@@ -23,26 +23,22 @@
 #
 # --------------------------------------------------------------------------
 import os
-import sys
 import json
+import time
 import ntpath
+import argparse
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
+from functools import partial
+from bbx_writer import BbxWriter
+from lease import LeaseQueue, drain, run_leased
+from pipeline import Throughput, image_bytes, load_or_skip, run_workers, shared_prefetch
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import tensorflow as tf  # noqa: E402
 
-# Usage check
-if len(sys.argv) != 5:
-    print('USAGE: python3 annotate_saved.py TOP_FOLDER MODEL LABEL_MAP CONFIDENCE')
-    print('EXAMPLE: python3 annotate_saved.py ../demo ../models/saved/ ../models/label_map.pbtxt 0.8')
-    sys.exit()
 FORMATS = [".jpg", ".jpeg", ".png"]
-PATH = sys.argv[1]
-MODEL = sys.argv[2]
-LABEL_MAP = sys.argv[3]
-THRESHOLD = float(sys.argv[4])
 
 
 # Helper functions so bboxee.schema does not have to be in pythonpath
@@ -114,68 +110,224 @@ def build_label_map(file_name):
     return label_map
 
 
-# Find all of the folders containing images
-folders = []
-walk_data = os.walk(PATH)
-for dirpath, dirs, files in walk_data:
-    f = (lambda x: os.path.splitext(x)[1].lower() in FORMATS)
-    image_list = list(filter(f, files))
-    if len(image_list) > 0:
-        folders.append((dirpath, image_list))
+def load_image(file_name):
+    """Read an image into an array."""
+    image = Image.open(file_name)
+    image_np = np.array(image)
+    image.close()
+    return image_np.shape, image_np
 
-# Parse label map
-label_map = build_label_map(LABEL_MAP)
 
-# Load model
-model = tf.saved_model.load(MODEL)
+def copied(decoded):
+    """Copy the images of shared_prefetch out of its ring, so the ring does
+    not have to hold a whole window of frames. They are stacked into
+    batches anyway."""
+    try:
+        for file_name, image in decoded:
+            yield file_name, None if image is None else (image[0], image[1].copy())
+    finally:
+        decoded.close()
 
-# Loop through all of the folder with images and process each image
-for index, (folder, images) in enumerate(folders):
-    print('Processing folder [{}] ({} of {})'.format(folder, str(index + 1), str(len(folders))))
+
+def build_entry(scores, boxes, classes, label_map):
+    """Build an annotation file entry from detections above threshold."""
+    entry = annotation_file_entry()
+    for score, (y_min, x_min, y_max, x_max), class_number in zip(scores.tolist(), boxes.tolist(), classes.tolist()):
+        annotation = annotation_block()
+        annotation['created_by'] = 'machine'
+        annotation['confidence'] = score
+        annotation['bbox']['xmin'] = x_min
+        annotation['bbox']['xmax'] = x_max
+        annotation['bbox']['ymin'] = y_min
+        annotation['bbox']['ymax'] = y_max
+        annotation['label'] = label_map.get(class_number, 'unknown')
+        entry['annotations'].append(annotation)
+    return entry
+
+
+class Detector:
+    """SavedModel wrapper that runs images of the same resolution in fixed
+    shape batches through one cached concrete function per shape."""
+
+    def __init__(self, model_dir, batch_size=1):
+        self.model = tf.saved_model.load(model_dir)
+        self.batch_size = max(1, batch_size)
+        self.functions = {}
+
+    def inference(self, images):
+        """Call the model through a concrete function cached per input shape."""
+        if self.trace(images.shape, images.dtype):
+            return self.functions[images.shape](tf.constant(images))
+        results = [self.model(image[np.newaxis]) for image in images]
+        keys = ['detection_scores', 'detection_boxes', 'detection_classes']
+        return {key: tf.concat([result[key] for result in results], 0) for key in keys}
+
+    def trace(self, shape, dtype):
+        """Trace a concrete function for a batch shape once, returns False
+        when images are passed to the model one at a time."""
+        if self.batch_size == 1:
+            return False
+        if shape not in self.functions:
+            try:
+                function = tf.function(lambda batch: self.model(batch))
+                self.functions[shape] = function.get_concrete_function(tf.TensorSpec(shape, tf.as_dtype(dtype)))
+            except (ValueError, TypeError):
+                # Models exported with a fixed batch dimension of one
+                print('Model does not accept batches, falling back to a batch size of 1')
+                self.batch_size = 1
+                return False
+        return True
+
+    def detect(self, window, threshold, label_map, stats=None):
+        """Group a window of (name, image) tuples by resolution and return
+        the annotation entries in window order."""
+        buckets = {}
+        for index, (_, image) in enumerate(window):
+            buckets.setdefault(image.shape, []).append(index)
+        entries = [None] * len(window)
+        for shape, bucket in buckets.items():
+            # Decided once per resolution, so a fall back to single images
+            # cannot change the step of the loop below
+            size = self.batch_size if self.trace((self.batch_size,) + shape, window[bucket[0]][1].dtype) else 1
+            for start in range(0, len(bucket), size):
+                batch = bucket[start:start + size]
+                images = np.stack([window[index][1] for index in batch])
+                if len(batch) < size:
+                    # Pad the last batch so every call reuses the same trace
+                    padding = np.zeros((size - len(batch),) + shape, dtype=images.dtype)
+                    images = np.concatenate((images, padding))
+                begin = time.perf_counter()
+                dets = self.inference(images)
+                if stats is not None:
+                    stats.add('inference', time.perf_counter() - begin, len(batch))
+                scores = dets['detection_scores'].numpy()
+                boxes = dets['detection_boxes'].numpy()
+                classes = dets['detection_classes'].numpy().astype(int)
+                keep = scores >= threshold
+                for row, index in enumerate(batch):
+                    mask = keep[row]
+                    entries[index] = build_entry(scores[row][mask], boxes[row][mask], classes[row][mask], label_map)
+        return entries
+
+
+def annotate_folder(detector, folder, images, decoded, window_size, threshold, label_map, progress, stats=None):
+    """Pass the decoded images of a folder through the detector a window at
+    a time and write the .bbx file of the folder."""
     bbx_file_name = '{}{}{}.bbx'.format(folder, os.path.sep, ntpath.split(folder)[1])
     bbx_data = annotation_file()
     bbx_data['analysts'].append('Machine Generated')
+    writer = BbxWriter(bbx_file_name)
 
-    # Pass each image through model
-    for i in tqdm(range(len(images))):
-        img = images[i]
-        file_name = os.path.join(folder, img)
-        image = Image.open(file_name)
-        image = Image.open(file_name)
-        # the array based representation of the image will be
-        # used later in order to prepare the result image with
-        # boxes and labels on it.
-        image_np = np.array(image)
-        # Expand dimensions since the model expects images
-        # to have shape: [1, None, None, 3]
-        image_np_expanded = np.expand_dims(image_np, axis=0)
-        # Actual detection.
-        dets = model(image_np_expanded)
-        entry = annotation_file_entry()
-        scores = dets['detection_scores'][0].numpy()
-        boxes = dets['detection_boxes'][0].numpy()
-        classes = dets['detection_classes'][0].numpy()
-        for index, score in enumerate(scores):
-            if score >= THRESHOLD:
-                annotation = annotation_block()
-                annotation['created_by'] = 'machine'
-                annotation['confidence'] = float(score)
-                bbox = boxes[index]
-                annotation['bbox']['xmin'] = float(bbox[1])
-                annotation['bbox']['xmax'] = float(bbox[3])
-                annotation['bbox']['ymin'] = float(bbox[0])
-                annotation['bbox']['ymax'] = float(bbox[2])
-                class_number = int(classes[index])
-                if class_number in label_map:
-                    label = label_map[class_number]
-                else:
-                    label = 'unknown'
-                annotation['label'] = label
-                entry['annotations'].append(annotation)
-        if len(entry['annotations']) > 0:
-            bbx_data['images'][img] = entry
+    # Pass each window of images through model
+    for start in range(0, len(images), window_size):
+        names = images[start:start + window_size]
+        window = [(img, next(decoded)[1]) for img in names]
+        # Unreadable frames get an empty line
+        window = [(img, decoded_image[1]) for img, decoded_image in window if decoded_image is not None]
+        entries = dict(zip([img for img, _ in window], detector.detect(window, threshold, label_map, stats)))
+        for img in names:
+            writer.add(img, entries.get(img, annotation_file_entry()))
+        progress.update(len(names))
 
     # Dump annotations
-    bbxfile = open(bbx_file_name, 'w')
-    json.dump(bbx_data, bbxfile)
-    bbxfile.close()
+    writer.compact(bbx_data)
+    return len(images)
+
+
+def start_worker(args):
+    """Load the model of a folder worker with its share of the cpu threads."""
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    return Detector(args.model, args.batch_size), build_label_map(args.label_map)
+
+
+def worker_folder(model, item, progress, args):
+    """Decode and annotate one (folder, images) work item in a worker."""
+    detector, label_map = model
+    folder, images = item
+    decoded = ((image_name, load_or_skip(load_image, os.path.join(folder, image_name))) for image_name in images)
+    window_size = max(1, args.batch_size) * 4
+    return annotate_folder(detector, folder, images, decoded, window_size, args.threshold, label_map, progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(epilog='EXAMPLE: python3 annotate_saved.py ../demo ../models/saved/ ../models/label_map.pbtxt 0.8')
+    parser.add_argument('path', metavar='TOP_FOLDER')
+    parser.add_argument('model', metavar='MODEL')
+    parser.add_argument('label_map', metavar='LABEL_MAP')
+    parser.add_argument('threshold', metavar='CONFIDENCE', type=float)
+    parser.add_argument('--processes', type=int, default=0,
+                        help='decode images on N processes through a shared memory ring')
+    parser.add_argument('--slots', type=int, default=16, help='number of images in the shared memory ring')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='number of images of the same resolution passed to the model at once')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='annotate folders on N processes that each load the model once')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='TensorFlow intra-op threads per worker, defaults to the cpu count divided by the workers')
+    parser.add_argument('--lease-dir',
+                        help='share the folders with other nodes running against the same lease directory')
+    parser.add_argument('--lease-ttl', type=float, default=300.0,
+                        help='seconds without a heartbeat after which the lease of a crashed node is reclaimed')
+    args = parser.parse_args()
+
+    # Find all of the folders containing images
+    folders = []
+    walk_data = os.walk(args.path)
+    for dirpath, dirs, files in walk_data:
+        f = (lambda x: os.path.splitext(x)[1].lower() in FORMATS)
+        image_list = list(filter(f, files))
+        if len(image_list) > 0:
+            folders.append((dirpath, image_list))
+
+    if args.lease_dir is not None:
+        # Folders are claimed one at a time by the workers of every node
+        args.workers = max(1, args.workers)
+    if args.workers > 0:
+        # Largest folders first so the workers finish at about the same time
+        folders.sort(key=lambda folder: len(folder[1]), reverse=True)
+        args.threads = args.threads or max(1, os.cpu_count() // args.workers)
+        print('Annotating {} folders on {} workers with {} threads each'.format(len(folders), args.workers, args.threads))
+        total = sum(len(images) for _, images in folders)
+        folder_work = partial(worker_folder, args=args)
+        if args.lease_dir is None:
+            run_workers(partial(start_worker, args), folder_work, folders, args.workers, total)
+        else:
+            queue = LeaseQueue(args.lease_dir, args.lease_ttl, args.lease_ttl / 5)
+            folder_work = partial(run_leased, folder_work, queue, args.path)
+            items = {os.path.relpath(folder, args.path): (folder, images) for folder, images in folders}
+            drain(queue, list(items), lambda keys: run_workers(partial(start_worker, args), folder_work,
+                                                               [items[key] for key in keys], args.workers, total))
+        return
+
+    # Parse label map
+    label_map = build_label_map(args.label_map)
+
+    # Images are collected into windows and bucketed by resolution
+    window_size = max(1, args.batch_size) * 4
+
+    # Decode images in the order they will be consumed
+    files = [os.path.join(folder, image_name) for folder, images in folders for image_name in images]
+    stats = None
+    if args.processes > 0 and len(files) > 0:
+        # Slots are sized to the first image, larger images are copied
+        stats = Throughput()
+        decoded = copied(shared_prefetch(partial(load_or_skip, load_image), files, image_bytes(files[0]), args.processes, args.slots, 1, stats))
+    else:
+        decoded = ((file_name, load_or_skip(load_image, file_name)) for file_name in files)
+
+    # Load model
+    detector = Detector(args.model, args.batch_size)
+
+    # Loop through all of the folder with images and process each image
+    for index, (folder, images) in enumerate(folders):
+        print('Processing folder [{}] ({} of {})'.format(folder, str(index + 1), str(len(folders))))
+        progress = tqdm(total=len(images))
+        annotate_folder(detector, folder, images, decoded, window_size, args.threshold, label_map, progress, stats)
+        progress.close()
+    decoded.close()
+    if stats is not None:
+        print(stats.summary())
+
+
+if __name__ == '__main__':
+    main()
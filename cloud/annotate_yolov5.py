@@ -23,27 +23,22 @@
 #
 # --------------------------------------------------------------------------
 import os
-import sys
-import json
+import math
+import time
 import torch
-import ntpath
+import argparse
 import numpy as np
 from PIL import Image
+from functools import partial
 from yolov5.utils.augmentations import letterbox
-from yolov5.utils.general import non_max_suppression, scale_boxes, xyxy2xywh
+from yolov5.utils.general import non_max_suppression, scale_boxes
 from tqdm import tqdm
+from bbx_writer import BbxWriter
+from lease import LeaseQueue, drain, run_leased
+from manifest import Manifest, bbx_file, fingerprint
+from pipeline import Throughput, load_or_skip, run_workers, shared_prefetch
 
-# Usage check
-if len(sys.argv) != 6:
-    print('USAGE: python3 annotate_yolov5.py TOP_DATA_FOLDER MODEL SHAPE STRIDE CONFIDENCE')
-    print('EXAMPLE: python3 annotate_yolov5.py ../demo ../models/md_v5a.0.1.pt 1280 64 0.8')
-    sys.exit()
 FORMATS = [".jpg", ".jpeg", ".png"]
-PATH = sys.argv[1]
-MODEL = sys.argv[2]
-SHAPE = int(sys.argv[3])
-STRIDE = int(sys.argv[4])
-THRESHOLD = float(sys.argv[5])
 
 
 # Helper functions so bboxee.schema does not have to be in pythonpath
@@ -82,83 +77,279 @@ def annotation_block():
             'schema': '1.0.0'}
 
 
-# Find all of the folders containing images
-folders = []
-walk_data = os.walk(PATH)
-for dirpath, dirs, files in walk_data:
-    f = (lambda x: os.path.splitext(x)[1].lower() in FORMATS)
-    image_list = list(filter(f, files))
-    if len(image_list) > 0:
-        folders.append((dirpath, image_list))
-
-# Load model
-device = 'cpu'
-if torch.cuda.is_available():
-    device = 'cuda:0'
-try:
-    if torch.backends.mps.is_built and torch.backends.mps.is_available():
-        device = 'mps'
-except AttributeError:
-    pass
-checkpoint = torch.load(MODEL)
-# Patch for older YOLOv5 models
-for m in checkpoint['model'].modules():
-    if isinstance(m, torch.nn.Upsample) and not hasattr(m, 'recompute_scale_factor'):
-        m.recompute_scale_factor = None
-model = checkpoint['model'].float().fuse().eval().to(device)
-
-# Loop through all of the folder with images and process each image
-for index, (folder, images) in enumerate(folders):
-    print('Processing folder [{}] ({} of {})'.format(folder, str(index + 1), str(len(folders))))
-    bbx_file_name = '{}{}{}.bbx'.format(folder, os.path.sep, ntpath.split(folder)[1])
-    bbx_data = annotation_file()
-    bbx_data['analysts'].append('Machine Generated')
+def load_image(file_name, shape, stride, reduced_decode=False):
+    """Read and letterbox an image, optionally letting libjpeg decode at
+    the smallest power of two scale that still covers shape."""
+    image = Image.open(file_name)
+    ratio = shape / max(image.size)
+    if reduced_decode and ratio < 1.0:
+        image.draft(image.mode, (math.ceil(image.width * ratio), math.ceil(image.height * ratio)))
+    img_original = np.asarray(image)
+    image.close()
+    # padded resize
+    img = letterbox(img_original, new_shape=shape, stride=stride, auto=True)[0]  # JIT requires auto=False
+    img = img.transpose((2, 0, 1))  # HWC to CHW; PIL Image is RGB already
+    img = np.ascontiguousarray(img)
+    return img_original.shape, img
 
-    # Pass each image through model
-    for i in tqdm(range(len(images))):
-        image_name = images[i]
-        file_name = os.path.join(folder, image_name)
-
-        image = Image.open(file_name)
-        img_original = np.asarray(image)
-        image.close()
-        # padded resize
-        img = letterbox(img_original, new_shape=SHAPE, stride=STRIDE, auto=True)[0]  # JIT requires auto=False
-        img = img.transpose((2, 0, 1))  # HWC to CHW; PIL Image is RGB already
-        img = np.ascontiguousarray(img)
-        img = torch.from_numpy(img)
-        img = img.float()
-        img /= 255
-        img = torch.unsqueeze(img, 0).to(device)
-        pred: list = model(img)[0]
-        pred = non_max_suppression(prediction=pred.cpu(), conf_thres=THRESHOLD)
-        gn = torch.tensor(img_original.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+
+def select_device():
+    """Fastest available torch device."""
+    device = 'cpu'
+    if torch.cuda.is_available():
+        device = 'cuda:0'
+    try:
+        if torch.backends.mps.is_built and torch.backends.mps.is_available():
+            device = 'mps'
+    except AttributeError:
+        pass
+    return device
+
+
+class Detector:
+    """YOLOv5 checkpoint, or an INT8 model run through onnxruntime when
+    session_file is set, that turns letterboxed images into entries."""
+
+    def __init__(self, model_file, session_file=None, intra_op_threads=0, inter_op_threads=0, device=None):
+        self.device = device or select_device()
+        self.session = None
+        if session_file is not None:
+            from quantize import load_names, load_session, to_yolov5_layout
+            self.layout = to_yolov5_layout
+            self.session = load_session(session_file, intra_op_threads, inter_op_threads)
+            self.input_name = self.session.get_inputs()[0].name
+            self.names = load_names(self.session)
+        else:
+            checkpoint = torch.load(model_file)
+            # Patch for older YOLOv5 models
+            for m in checkpoint['model'].modules():
+                if isinstance(m, torch.nn.Upsample) and not hasattr(m, 'recompute_scale_factor'):
+                    m.recompute_scale_factor = None
+            self.model = checkpoint['model'].float().fuse().eval().to(self.device)
+            self.names = self.model.names
+
+    def detect(self, img, original_shape, threshold, stats=None):
+        """Pass one letterboxed image through the model and return the
+        annotation file entry of the detections above threshold."""
+        start = time.perf_counter()
+        shape = img.shape[1:]
+        if self.session is not None:
+            img = img[np.newaxis].astype(np.float32) / 255
+            pred = torch.from_numpy(self.layout(self.session.run(None, {self.input_name: img})[0], len(self.names)))
+        else:
+            img = torch.from_numpy(img)
+            img = img.to(self.device).float()
+            img /= 255
+            img = torch.unsqueeze(img, 0)
+            pred = self.model(img)[0].cpu()
+        pred = non_max_suppression(prediction=pred, conf_thres=threshold)
+        if stats is not None:
+            stats.add('inference', time.perf_counter() - start)
+        gn = torch.tensor(original_shape)[[1, 0, 1, 0]]  # normalization gain whwh
         entry = annotation_file_entry()
         for det in pred:
             if len(det):
-                # Rescale boxes
-                det[:, :4] = scale_boxes(img.shape[2:], det[:, :4], img_original.shape).round()
-                for *box, conf, cls in reversed(det):
+                # Rescale boxes and normalize them in one pass, newest first
+                det[:, :4] = scale_boxes(shape, det[:, :4], original_shape).round()
+                det = det.flip(0)
+                boxes = (det[:, :4] / gn).tolist()
+                confidences = det[:, 4].tolist()
+                classes = det[:, 5].int().tolist()
+                for (x_min, y_min, x_max, y_max), conf, cls in zip(boxes, confidences, classes):
                     annotation = annotation_block()
                     annotation['created_by'] = 'machine'
-                    # normalized center-x, center-y, width and height
-                    bbox = (xyxy2xywh(torch.tensor(box).view(1, 4)) / gn).view(-1).tolist()
-                    x_center, y_center, width_of_box, height_of_box = bbox
-                    x_min = x_center - width_of_box / 2.0
-                    y_min = y_center - height_of_box / 2.0
-                    x_max = x_center + width_of_box / 2.0
-                    y_max = y_center + height_of_box / 2.0
                     annotation['bbox']['xmin'] = x_min
                     annotation['bbox']['xmax'] = x_max
                     annotation['bbox']['ymin'] = y_min
                     annotation['bbox']['ymax'] = y_max
-                    annotation['label'] = model.names[int(cls.item())]
-                    annotation['confidence'] = conf.item()
+                    annotation['label'] = self.names[cls]
+                    annotation['confidence'] = conf
                     entry['annotations'].append(annotation)
-        if len(entry['annotations']) > 0:
-            bbx_data['images'][image_name] = entry
+        return entry
+
+
+def annotate_folder(detector, folder, images, decoded, threshold, progress, stats=None,
+                    start=0, manifest=None, checkpoint=100):
+    """Pass the decoded images of a folder from start on through the detector
+    and write the .bbx file of the folder.
+
+    Entries are appended to a partial file that is flushed to disk every
+    checkpoint images, when the manifest records the number of images done,
+    and compacted into the .bbx at the end. A folder resumed from start
+    continues the partial file of the earlier run.
+    """
+    bbx_file_name = bbx_file(folder)
+    bbx_data = annotation_file()
+    bbx_data['analysts'].append('Machine Generated')
+    writer = BbxWriter(bbx_file_name, start, checkpoint)
+
+    # Pass each image through model
+    for index in range(start, len(images)):
+        image_name = images[index]
+        _, decoded_image = next(decoded)
+        if decoded_image is None:
+            # Unreadable frames get an empty line so a resumed run moves past them
+            entry = annotation_file_entry()
+        else:
+            original_shape, img = decoded_image
+            entry = detector.detect(img, original_shape, threshold, stats)
+        if writer.add(image_name, entry) and manifest is not None:
+            manifest.update(folder, len(images), index + 1)
+        progress.update(1)
 
     # Dump annotations
-    bbxfile = open(bbx_file_name, 'w')
-    json.dump(bbx_data, bbxfile, indent=2)
-    bbxfile.close()
+    writer.compact(bbx_data)
+    if manifest is not None:
+        manifest.update(folder, len(images), len(images), complete=True)
+    return len(images) - start
+
+
+def start_worker(args, session_file):
+    """Load the model of a folder worker with its share of the cpu threads."""
+    torch.set_num_threads(args.threads)
+    # An onnxruntime session would otherwise use every core in each worker
+    return Detector(args.model, session_file, args.intra_op_threads or args.threads, args.inter_op_threads)
+
+
+def shared_detector(model_file):
+    """Load the model on the cpu with its parameters in shared memory, for
+    workers forked after loading."""
+    # Keep the parent single threaded so no thread pool is forked
+    torch.set_num_threads(1)
+    detector = Detector(model_file, device='cpu')
+    detector.model.share_memory()
+    return detector
+
+
+def worker_folder(detector, item, progress, args, manifest=None):
+    """Decode and annotate one (folder, images, start) work item in a worker."""
+    folder, images, start = item
+    if manifest is not None:
+        # Another node may have got further with the folder since the run started
+        manifest.reload()
+        start = manifest.resume(folder, images)
+        if start is None:
+            return 0
+    function = partial(load_image, shape=args.shape, stride=args.stride, reduced_decode=args.reduced_decode)
+    decoded = ((image_name, load_or_skip(function, os.path.join(folder, image_name))) for image_name in images[start:])
+    return annotate_folder(detector, folder, images, decoded, args.threshold, progress,
+                           start=start, manifest=manifest, checkpoint=args.checkpoint)
+
+
+def main():
+    parser = argparse.ArgumentParser(epilog='EXAMPLE: python3 annotate_yolov5.py ../demo ../models/md_v5a.0.1.pt 1280 64 0.8')
+    parser.add_argument('path', metavar='TOP_DATA_FOLDER')
+    parser.add_argument('model', metavar='MODEL')
+    parser.add_argument('shape', metavar='SHAPE', type=int)
+    parser.add_argument('stride', metavar='STRIDE', type=int)
+    parser.add_argument('threshold', metavar='CONFIDENCE', type=float)
+    parser.add_argument('--processes', type=int, default=0,
+                        help='decode images on N processes through a shared memory ring')
+    parser.add_argument('--slots', type=int, default=16, help='number of images in the shared memory ring')
+    parser.add_argument('--reduced-decode', action='store_true',
+                        help='decode JPEGs at a reduced scale that still covers SHAPE')
+    parser.add_argument('--quantize', choices=['dynamic', 'static'],
+                        help='run the model with INT8 weights on the cpu through onnxruntime')
+    parser.add_argument('--calibration-images', type=int, default=32,
+                        help='number of images used to calibrate and check the quantized model')
+    parser.add_argument('--intra-op-threads', type=int, default=0,
+                        help='onnxruntime intra-op threads, defaults to --threads with --workers')
+    parser.add_argument('--inter-op-threads', type=int, default=0, help='onnxruntime inter-op threads')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='annotate folders on N processes that each load the model once')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch and onnxruntime threads per worker, defaults to the cpu count divided by the workers')
+    parser.add_argument('--fork', action='store_true',
+                        help='load the model once and fork the workers so they share its memory, cpu only')
+    parser.add_argument('--manifest',
+                        help='run manifest used to resume an interrupted run, defaults to TOP_DATA_FOLDER/annotate_yolov5.json')
+    parser.add_argument('--checkpoint', type=int, default=100,
+                        help='flush the annotations of a folder to disk and update the manifest every N images')
+    parser.add_argument('--restart', action='store_true', help='ignore the manifest and annotate every folder')
+    parser.add_argument('--lease-dir',
+                        help='share the folders with other nodes running against the same lease directory')
+    parser.add_argument('--lease-ttl', type=float, default=300.0,
+                        help='seconds without a heartbeat after which the lease of a crashed node is reclaimed')
+    args = parser.parse_args()
+    if args.fork and (args.workers == 0 or args.quantize is not None):
+        parser.error('--fork needs --workers and does not support --quantize')
+
+    # Find all of the folders containing images, sorted so an
+    # interrupted folder can be resumed at the same image
+    folders = []
+    walk_data = os.walk(args.path)
+    for dirpath, dirs, files in walk_data:
+        f = (lambda x: os.path.splitext(x)[1].lower() in FORMATS)
+        image_list = sorted(filter(f, files))
+        if len(image_list) > 0:
+            folders.append((dirpath, image_list))
+
+    # Decode images in the order they will be consumed
+    function = partial(load_image, shape=args.shape, stride=args.stride, reduced_decode=args.reduced_decode)
+    files = [os.path.join(folder, image_name) for folder, images in folders for image_name in images]
+
+    session_file = None
+    if args.quantize is not None:
+        # INT8 model cached next to the checkpoint, calibrated on a sample of the images
+        from quantize import quantize, sample
+        session_file = quantize(args.model, args.quantize, sample(files, args.calibration_images), function, image_size=args.shape)
+
+    # Skip complete folders and resume partial ones where the last run stopped
+    settings = {'model': fingerprint(args.model), 'threshold': args.threshold, 'shape': args.shape,
+                'stride': args.stride, 'reduced_decode': args.reduced_decode, 'quantize': args.quantize}
+    manifest = Manifest(args.manifest or os.path.join(args.path, 'annotate_yolov5.json'), settings, args.restart)
+    work = [(folder, images, manifest.resume(folder, images)) for folder, images in folders]
+    work = [item for item in work if item[2] is not None]
+    total = len(files)
+    files = [os.path.join(folder, image_name) for folder, images, start in work for image_name in images[start:]]
+    if len(files) < total:
+        print('Resuming: {} of {} folders complete, {} of {} images left'.format(
+            len(folders) - len(work), len(folders), len(files), total))
+
+    if args.lease_dir is not None:
+        # Folders are claimed one at a time by the workers of every node
+        args.workers = max(1, args.workers)
+    if args.workers > 0:
+        # Largest folders first so the workers finish at about the same time
+        work.sort(key=lambda item: len(item[1]) - item[2], reverse=True)
+        args.threads = args.threads or max(1, os.cpu_count() // args.workers)
+        print('Annotating {} folders on {} workers with {} threads each'.format(len(work), args.workers, args.threads))
+        folder_work = partial(worker_folder, args=args, manifest=manifest)
+        setup, initialize = partial(start_worker, args, session_file), None
+        if args.fork:
+            setup, initialize = partial(shared_detector, args.model), partial(torch.set_num_threads, args.threads)
+        if args.lease_dir is None:
+            run_workers(setup, folder_work, work, args.workers, len(files), initialize, args.fork)
+        else:
+            queue = LeaseQueue(args.lease_dir, args.lease_ttl, args.lease_ttl / 5)
+            folder_work = partial(run_leased, folder_work, queue, args.path)
+            items = {os.path.relpath(item[0], args.path): item for item in work}
+            drain(queue, list(items), lambda keys: run_workers(setup, folder_work, [items[key] for key in keys],
+                                                               args.workers, len(files), initialize, args.fork))
+        return
+
+    # Load model
+    detector = Detector(args.model, session_file, args.intra_op_threads, args.inter_op_threads)
+    stats = None
+    if args.processes > 0:
+        # Letterboxed images are never larger than the stride aligned shape
+        side = math.ceil(args.shape / args.stride) * args.stride
+        stats = Throughput()
+        decoded = shared_prefetch(partial(load_or_skip, function), files, side * side * 3, args.processes, args.slots, 1, stats)
+    else:
+        decoded = ((file_name, load_or_skip(function, file_name)) for file_name in files)
+
+    # Loop through all of the folder with images and process each image
+    for index, (folder, images, start) in enumerate(work):
+        print('Processing folder [{}] ({} of {})'.format(folder, str(index + 1), str(len(work))))
+        progress = tqdm(total=len(images), initial=start)
+        annotate_folder(detector, folder, images, decoded, args.threshold, progress, stats,
+                        start, manifest, args.checkpoint)
+        progress.close()
+    decoded.close()
+    if stats is not None:
+        print(stats.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+# Incremental .bbx writer for the cloud annotation scripts
+import os
+import json
+
+
+def partial_file(bbx_file_name):
+    """The line per image file a .bbx is built from while its folder runs."""
+    return bbx_file_name + '.partial.jsonl'
+
+
+def line_offsets(file_name):
+    """Byte offset after each complete line of a file, a torn last line
+    left by an interrupted run is not counted."""
+    offsets = []
+    if not os.path.exists(file_name):
+        return offsets
+    offset = 0
+    with open(file_name, 'rb') as file:
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            offsets.append(offset)
+    return offsets
+
+
+def completed(bbx_file_name):
+    """Number of images already in the partial file of a .bbx."""
+    return len(line_offsets(partial_file(bbx_file_name)))
+
+
+class BbxWriter:
+    """Write the entries of a folder as they are made and build the .bbx
+    from them at the end, so memory use does not grow with the folder.
+
+    Each image appends a [image_name, entry] line, entry None when it has no
+    annotations, to the partial file, which is flushed to disk every
+    flush_every images. With start, the first start lines of an earlier
+    run are kept and writing continues after them.
+    """
+
+    def __init__(self, bbx_file_name, start=0, flush_every=100):
+        """Class init function."""
+        self.bbx_file_name = bbx_file_name
+        self.file_name = partial_file(bbx_file_name)
+        self.flush_every = max(1, flush_every)
+        self.count = start
+        if start > 0:
+            offset = line_offsets(self.file_name)[start - 1]
+            self.file = open(self.file_name, 'r+b')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file = open(self.file_name, 'wb')
+
+    def add(self, image_name, entry):
+        """Append the entry of an image, returns True when the lines were
+        flushed to disk."""
+        if len(entry['annotations']) == 0:
+            entry = None
+        self.file.write((json.dumps([image_name, entry]) + '\n').encode('utf-8'))
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def compact(self, bbx_data):
+        """Stream the lines into the .bbx and remove the partial file.
+        bbx_data provides every key of the annotation file but 'images'."""
+        self.file.close()
+        temporary = '{}.{}.tmp'.format(self.bbx_file_name, os.getpid())
+        with open(temporary, 'w') as bbxfile, open(self.file_name, 'rb') as lines:
+            separator = '{'
+            for key, value in bbx_data.items():
+                bbxfile.write('{}{}: '.format(separator, json.dumps(key)))
+                separator = ', '
+                if key != 'images':
+                    bbxfile.write(json.dumps(value))
+                    continue
+                comma = ''
+                bbxfile.write('{')
+                for line in lines:
+                    image_name, entry = json.loads(line)
+                    if entry is not None:
+                        bbxfile.write('{}{}: {}'.format(comma, json.dumps(image_name), json.dumps(entry)))
+                        comma = ', '
+                bbxfile.write('}')
+            bbxfile.write('}')
+        os.replace(temporary, self.bbx_file_name)
+        os.remove(self.file_name)
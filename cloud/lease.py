@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+# Coordinator free folder queue for several nodes sharing a file system
+import os
+import time
+import uuid
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+
+def lease_name(key):
+    """File name stem of a work item, readable and unique for its key."""
+    base = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in os.path.basename(key.rstrip('/'))) or 'root'
+    return '{}-{}'.format(base[:64], hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+
+class Lease:
+    """A claimed work item, kept alive by a heartbeat thread that touches
+    the lease file until the lease is released."""
+
+    def __init__(self, path, owner, heartbeat):
+        """Class init function."""
+        self.path = path
+        self.owner = owner
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, args=(heartbeat,), daemon=True)
+        self.thread.start()
+
+    def beat(self, heartbeat):
+        while not self.stopped.wait(heartbeat):
+            try:
+                with open(self.path) as file:
+                    if file.read() != self.owner:
+                        raise FileNotFoundError(self.path)
+                os.utime(self.path, None)
+            except OSError:
+                # Reclaimed by another node after missing heartbeats
+                self.lost = True
+                return
+
+    def release(self, done=True):
+        """Stop the heartbeat, mark the item done and remove the lease."""
+        self.stopped.set()
+        self.thread.join()
+        if done and not self.lost:
+            with open(self.path[:-len('.lease')] + '.done', 'w') as file:
+                file.write(self.owner)
+        if not self.lost:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class LeaseLost(Exception):
+    """Raised in the work of an item whose lease another process reclaimed."""
+
+
+class LeasedProgress:
+    """Progress counter of a leased item, a drop in for tqdm.update that
+    stops the work at the next image once the heartbeat finds the lease was
+    lost, so two processes do not keep writing the same output."""
+
+    def __init__(self, counter, lease):
+        """Class init function."""
+        self.counter = counter
+        self.lease = lease
+
+    def update(self, images=1):
+        self.counter.update(images)
+        if self.lease.lost:
+            raise LeaseLost(self.lease.path)
+
+
+class LeaseQueue:
+    """Work queue shared by several processes or nodes through lease files.
+
+    A process claims an item by creating <item>.lease with O_EXCL, which is
+    atomic on local file systems and NFSv3+, and keeps it alive by touching
+    it every heartbeat seconds. A lease not touched for ttl seconds belongs
+    to a crashed process and is reclaimed; <item>.reclaim, also created with
+    O_EXCL, makes sure only one process does so. Finished items get a
+    <item>.done marker and are never claimed again. Ages are measured with
+    the clock of the file server, so node clocks do not need to agree.
+    """
+
+    def __init__(self, directory, ttl=300.0, heartbeat=60.0):
+        """Class init function."""
+        self.directory = directory
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        os.makedirs(directory, exist_ok=True)
+
+    def process(self):
+        """Host and pid of the calling process, looked up on every call as
+        the queue is pickled into pool workers."""
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, lease_name(key) + suffix)
+
+    def now(self):
+        """Current time of the file server, read from a touched probe file."""
+        probe = os.path.join(self.directory, '.clock-{}'.format(lease_name(self.process())))
+        with open(probe, 'a'):
+            pass
+        os.utime(probe, None)
+        return os.stat(probe).st_mtime
+
+    def expired(self, path):
+        """True when a file exists and was not touched for ttl seconds."""
+        try:
+            return self.now() - os.stat(path).st_mtime > self.ttl
+        except FileNotFoundError:
+            return False
+
+    def create(self, path, owner):
+        """Atomically create a file holding the owner, False if it exists."""
+        try:
+            descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(descriptor, 'w') as file:
+            file.write(owner)
+        return True
+
+    def done(self, key):
+        return os.path.exists(self.path(key, '.done'))
+
+    def claimable(self, key):
+        """True when nobody holds a live lease on an unfinished item."""
+        lease = self.path(key, '.lease')
+        return not self.done(key) and (not os.path.exists(lease) or self.expired(lease))
+
+    def claim(self, key):
+        """Claim the item key, returns a Lease or None when the item is done
+        or another live process holds it."""
+        if self.done(key):
+            return None
+        # Unique per claim, so sibling workers never pass for each other
+        owner = '{}:{}'.format(self.process(), uuid.uuid4().hex)
+        lease = self.path(key, '.lease')
+        if not self.create(lease, owner):
+            if not self.expired(lease):
+                return None
+            reclaim = self.path(key, '.reclaim')
+            if not self.create(reclaim, owner):
+                # A reclaim left behind by a crash expires like a lease
+                if self.expired(reclaim):
+                    os.remove(reclaim)
+                return None
+            try:
+                # Check again, the lease may have been renewed meanwhile
+                if self.expired(lease):
+                    print('Reclaiming expired lease {}'.format(lease))
+                    os.remove(lease)
+                if not self.create(lease, owner):
+                    return None
+            finally:
+                os.remove(reclaim)
+        if self.done(key):
+            # Finished by the holder of the lease that was just reclaimed
+            os.remove(lease)
+            return None
+        return Lease(lease, owner, self.heartbeat)
+
+
+def run_leased(work, queue, top, model, item, counter):
+    """Run work(model, item, counter) on a (folder, ...) work item only when
+    this process claims the lease of the folder, returns 0 otherwise.
+
+    The counter passed to work raises LeaseLost on its next update once the
+    lease is lost, which stops the folder before its .bbx is written.
+    """
+    key = os.path.relpath(item[0], top)
+    lease = queue.claim(key)
+    if lease is None:
+        return 0
+    try:
+        result = work(model, item, LeasedProgress(counter, lease))
+    except LeaseLost:
+        lease.release(done=False)
+        print('Lease of {} was reclaimed, stopped processing it'.format(key))
+        return 0
+    except BaseException:
+        lease.release(done=False)
+        raise
+    lease.release(done=True)
+    if lease.lost:
+        print('Lease of {} was reclaimed while it was being processed'.format(key))
+    return result
+
+
+def drain(queue, keys, run):
+    """Call run(keys) with the items that can be claimed until every item
+    is done, by this node or another. Items other nodes hold are waited
+    for and run again when their lease expires."""
+    while True:
+        keys = [key for key in keys if not queue.done(key)]
+        if len(keys) == 0:
+            return
+        claimable = [key for key in keys if queue.claimable(key)]
+        if len(claimable) > 0:
+            run(claimable)
+        else:
+            time.sleep(queue.heartbeat)
+
+
+def _simulate(queue, items, delay, crash):
+    """Self test worker, claim and 'process' items through a queue pickled
+    from the parent like in the pool workers, optionally dying while
+    holding a lease."""
+    directory = queue.directory
+
+    def run(keys):
+        for key in keys:
+            lease = queue.claim(key)
+            if lease is None:
+                continue
+            if crash:
+                # Leave the lease behind without heartbeats, like a dead node
+                lease.stopped.set()
+                os._exit(1)
+            time.sleep(delay)
+            with open(os.path.join(directory, 'processed.log'), 'a') as log:
+                log.write('{} {}\n'.format(key, lease.owner))
+            lease.release()
+    drain(queue, items, run)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several processes against one lease directory and check '
+                                                 'that every item is processed exactly once.')
+    parser.add_argument('--directory', help='lease directory, e.g. on an NFS share, defaults to a temp directory')
+    parser.add_argument('--items', type=int, default=40)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds to process an item')
+    args = parser.parse_args()
+    directory = args.directory or tempfile.mkdtemp(prefix='bboxee-leases-')
+    items = ['folder{:03d}'.format(index) for index in range(args.items)]
+    queue = LeaseQueue(directory, ttl=1.0, heartbeat=0.2)
+    context = multiprocessing.get_context('spawn')
+    # The first process dies holding a lease, the others reclaim it once it expires
+    crashed = context.Process(target=_simulate, args=(queue, items, args.delay, True))
+    crashed.start()
+    crashed.join()
+    processes = [context.Process(target=_simulate, args=(queue, items, args.delay, False))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    with open(os.path.join(directory, 'processed.log')) as log:
+        lines = [line.split() for line in log]
+    processed = [key for key, _ in lines]
+    owners = [owner for _, owner in lines]
+    missing = sorted(set(items) - set(processed))
+    repeated = sorted(item for item in set(processed) if processed.count(item) > 1)
+    # Every claim, also in sibling processes sharing the pickled queue, has its own owner
+    shared = len(owners) - len(set(owners))
+    workers = len(set(owner.rsplit(':', 1)[0] for owner in owners))
+    print('{} items, {} processed, {} missing, {} processed more than once, {} shared owners, {} processes ({})'.format(
+        len(items), len(processed), len(missing), len(repeated), shared, workers, directory))
+    if missing or repeated or shared:
+        raise SystemExit(1)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+# Resumable run manifest for the cloud annotation scripts
+import os
+import json
+import fcntl
+import hashlib
+from bbx_writer import completed
+
+
+def fingerprint(model_file):
+    """sha1 of the model file contents, stable when the model is copied
+    between machines."""
+    digest = hashlib.sha1()
+    with open(model_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bbx_file(folder):
+    """The .bbx file the scripts write for a folder."""
+    return os.path.join(folder, os.path.basename(os.path.normpath(folder)) + '.bbx')
+
+
+class Manifest:
+    """JSON record of the settings of a run and how far each folder got.
+
+    Folders are 'partial' until their .bbx is written in full and they are
+    'complete'. A partial folder resumes after the images, in sorted order,
+    already in its partial file. Updates hold an exclusive lock on the
+    manifest so worker processes and nodes can share it. A manifest written
+    with different settings, or with restart, is started over.
+    """
+
+    def __init__(self, file_name, settings, restart=False):
+        """Class init function."""
+        self.file_name = file_name
+        self.settings = settings
+        self.folders = {}
+        if restart or not self.reload():
+            if os.path.exists(file_name) and not restart:
+                print('Manifest {} was written with different settings, starting over'.format(file_name))
+            self.write()
+
+    def reload(self):
+        """Read the folder states other processes recorded, returns False
+        when there is no manifest with the same settings."""
+        if not os.path.exists(self.file_name):
+            return False
+        with open(self.file_name) as file:
+            data = json.load(file)
+        if data.get('settings') != self.settings:
+            return False
+        self.folders = data.get('folders', {})
+        return True
+
+    def resume(self, folder, images):
+        """Index of the first image of a folder that still has to be
+        annotated, None when the folder is complete and can be skipped.
+
+        A partial folder with every image in its partial file returns
+        len(images), it still has to be compacted into its .bbx.
+        """
+        state = self.folders.get(folder)
+        if state is None or state['images'] != len(images):
+            return 0
+        if state['state'] == 'partial':
+            return min(completed(bbx_file(folder)), len(images))
+        try:
+            written = os.path.getmtime(bbx_file(folder))
+        except OSError:
+            return 0
+        if all(os.path.getmtime(os.path.join(folder, image_name)) < written for image_name in images):
+            return None
+        return 0
+
+    def update(self, folder, images, done, complete=False):
+        """Record that done of the images of a folder are in its partial
+        file, or with complete that its .bbx was written."""
+        with open(self.file_name + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Start from what other workers recorded since this one read it
+            self.reload()
+            state = 'complete' if complete else 'partial'
+            self.folders[folder] = {'images': images, 'done': done, 'state': state}
+            self.write()
+
+    def write(self):
+        """Replace the manifest file in one step so it is never half written."""
+        temporary = '{}.{}.tmp'.format(self.file_name, os.getpid())
+        with open(temporary, 'w') as file:
+            json.dump({'settings': self.settings, 'folders': self.folders}, file, indent=2)
+        os.replace(temporary, self.file_name)
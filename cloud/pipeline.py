@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+# Process pool decoding helpers, mirrors bboxee.annotator.pipeline so bboxee
+# does not have to be in pythonpath
+import os
+import time
+import threading
+import numpy as np
+from PIL import Image
+import multiprocessing
+from itertools import islice
+from collections import deque
+from functools import partial
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+# Shared memory ring attached to by each decoding process
+_ring = None
+# Model and progress counter of a folder worker process
+_worker = None
+
+
+class Throughput:
+    """Accumulate the time spent and images handled by each pipeline stage."""
+
+    def __init__(self):
+        """Class init function."""
+        self.started = time.perf_counter()
+        self.seconds = {}
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, images=1):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.images[stage] = self.images.get(stage, 0) + images
+
+    def summary(self):
+        """Return a one line per stage report of images/sec."""
+        lines = []
+        for stage in self.seconds:
+            seconds = self.seconds[stage]
+            rate = self.images[stage] / seconds if seconds > 0 else 0.0
+            lines.append('{}: {} images, {:0.1f}s busy, {:0.1f} images/s'.format(stage, self.images[stage], seconds, rate))
+        lines.append('wall: {:0.1f}s'.format(time.perf_counter() - self.started))
+        return '\n'.join(lines)
+
+
+def load_or_skip(function, file_name):
+    """Apply an image loader to a file, returns None and names the file when
+    it cannot be decoded, so one corrupt frame does not stop its folder."""
+    try:
+        return function(file_name)
+    except Exception as error:
+        print('Skipping {}, it could not be decoded: {}'.format(file_name, error))
+        return None
+
+
+def _attach(name, slot_size):
+    """Process pool initializer, attach a decoding process to the ring."""
+    global _ring
+    try:
+        memory = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13, the block is registered with the parent's resource
+        # tracker which is shared by the spawned processes
+        memory = shared_memory.SharedMemory(name=name)
+    _ring = (memory, slot_size)
+
+
+def _fill(function, item, slot):
+    """Run function on item in a decoding process and copy the resulting
+    array into its slot of the ring."""
+    start = time.perf_counter()
+    result = function(item)
+    if result is not None:
+        meta, array = result
+        memory, slot_size = _ring
+        shape, dtype = array.shape, array.dtype
+        if array.nbytes <= slot_size:
+            view = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=slot * slot_size)
+            view[...] = array
+            array = None
+        # Arrays that do not fit in a slot are pickled back instead
+        result = (meta, shape, dtype, array)
+    return result, time.perf_counter() - start
+
+
+def shared_prefetch(function, items, slot_size, processes=2, slots=16, hold=1, stats=None):
+    """Generator that applies function to each item on a pool of processes.
+
+    function must be picklable and return None or a (meta, array) tuple. The
+    arrays are written into a shared memory ring of fixed size slots and
+    yielded as (item, (meta, array)) tuples in the same order as items, where
+    array is a view into the ring. A slot is reused once the consumer has
+    requested hold more items, so views must be copied if they are kept
+    longer than that. When stats is set, decode and wait times are recorded.
+    """
+    slots = max(slots, hold + 1)
+    memory = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+    pool = ProcessPoolExecutor(max_workers=max(1, processes),
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_attach,
+                               initargs=(memory.name, slot_size))
+    pending = deque()
+    items = iter(items)
+    submitted = 0
+    yielded = 0
+    try:
+        while True:
+            released = max(0, yielded - hold)
+            for item in islice(items, slots - (submitted - released)):
+                pending.append((item, pool.submit(_fill, function, item, submitted % slots)))
+                submitted += 1
+            if len(pending) == 0:
+                break
+            item, future = pending.popleft()
+            start = time.perf_counter()
+            result, seconds = future.result()
+            if stats is not None:
+                stats.add('wait', time.perf_counter() - start)
+                stats.add('decode', seconds)
+            slot = yielded % slots
+            yielded += 1
+            if result is not None:
+                meta, shape, dtype, array = result
+                if array is None:
+                    array = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=slot * slot_size)
+                result = (meta, array)
+            yield item, result
+    finally:
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+        try:
+            memory.close()
+        except BufferError:
+            # Views into the ring are still referenced, the mapping is
+            # released when they are garbage collected
+            pass
+        memory.unlink()
+
+
+def image_bytes(file_name):
+    """Size in bytes of a decoded RGB image, only the header is read."""
+    image = Image.open(file_name)
+    width, height = image.size
+    image.close()
+    return width * height * 3
+
+
+class Counter:
+    """Images done by all folder workers, a drop in for tqdm.update."""
+
+    def __init__(self, value):
+        """Class init function."""
+        self.value = value
+
+    def update(self, images=1):
+        with self.value.get_lock():
+            self.value.value += images
+
+
+def memory():
+    """Resident, shared and proportional set size in bytes of this process,
+    None where /proc/self/smaps_rollup (Linux 4.14+) is not available."""
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    except OSError:
+        return None
+    return fields.get('Rss', 0), fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0), fields.get('Pss', 0)
+
+
+def memory_report(label, usage):
+    """Format the memory() usage of a process."""
+    if usage is None:
+        return '{}: memory usage not available'.format(label)
+    resident, shared, proportional = (value / 2 ** 20 for value in usage)
+    return '{}: {:0.0f} MB resident, {:0.0f} MB shared, {:0.0f} MB proportional'.format(label, resident, shared, proportional)
+
+
+def _start_worker(setup, value, initialize=None, model=None):
+    """Process pool initializer, load the model of a folder worker once
+    unless it was inherited from the parent."""
+    global _worker
+    if initialize is not None:
+        initialize()
+    if model is None:
+        model = setup()
+    _worker = (model, Counter(value))
+
+
+def _run_folder(work, item):
+    """Process a work item with the model of this worker."""
+    model, counter = _worker
+    return work(model, item, counter), os.getpid(), memory()
+
+
+def run_workers(setup, work, items, workers, total, initialize=None, fork=False):
+    """Process items on a pool of worker processes that each load a model.
+
+    setup is called once in each worker and returns its model, then work(model,
+    item, counter) is called for each item the worker pulls from the shared
+    queue. Both must be picklable. work reports finished images with
+    counter.update(n), which a single tqdm bar sums over all workers.
+    initialize, e.g. to set the number of threads, runs first in each worker.
+
+    With fork, setup runs once in this process and the workers are forked
+    after it, so they share the pages of the model copy-on-write instead of
+    each loading a copy. The resident and shared memory of each worker is
+    printed at the end. Returns the results of work in the order of items.
+    """
+    context = multiprocessing.get_context('fork' if fork else 'spawn')
+    value = context.Value('q', 0)
+    initargs = (setup, value, initialize, None)
+    if fork:
+        initargs = (None, value, initialize, setup())
+        print(memory_report('parent', memory()))
+    with context.Pool(max(1, workers), initializer=_start_worker, initargs=initargs) as pool:
+        results = pool.map_async(partial(_run_folder, work), items, chunksize=1)
+        progress = tqdm(total=total, unit='img')
+        while not results.ready():
+            results.wait(0.5)
+            progress.update(value.value - progress.n)
+        progress.update(value.value - progress.n)
+        progress.close()
+        results = results.get()
+    usage = {}
+    for _, pid, snapshot in results:
+        usage[pid] = snapshot
+    for pid, snapshot in usage.items():
+        print(memory_report('worker {}'.format(pid), snapshot))
+    return [result for result, _, _ in results]
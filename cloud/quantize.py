@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+# Bounding Box Editor and Exporter (BBoxEE)
+# Author: Peter Ersts (ersts@amnh.org)
+#
+# --------------------------------------------------------------------------
+#
+# This file is part of Animal Detection Network's (Andenet)
+# Bounding Box Editor and Exporter (BBoxEE)
+#
+# BBoxEE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BBoxEE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+#
+# --------------------------------------------------------------------------
+# ONNX export and INT8 quantization helpers, mirrors bboxee.annotator.yolo_onnx
+# and bboxee.annotator.quantize so bboxee does not have to be in pythonpath
+import os
+import ast
+import json
+import time
+import torch
+import numpy as np
+import onnxruntime as ort
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from yolov5.utils.general import non_max_suppression
+from yolov5.utils.metrics import box_iou
+
+MODES = ['dynamic', 'static']
+
+
+def load_model(model_file, device):
+    """Load a YOLOv5 checkpoint and prepare it for inference."""
+    checkpoint = torch.load(model_file)
+    # Patch for older YOLOv5 models
+    for m in checkpoint['model'].modules():
+        if isinstance(m, torch.nn.Upsample) and not hasattr(m, 'recompute_scale_factor'):
+            m.recompute_scale_factor = None
+    return checkpoint['model'].float().fuse().eval().to(device)
+
+
+def load_session(model_file, intra_op_threads=0, inter_op_threads=0):
+    """Create an onnxruntime cpu session, zero threads lets onnxruntime decide."""
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return ort.InferenceSession(model_file, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def load_names(session):
+    """Read the class names stored in the model metadata by the export."""
+    metadata = session.get_modelmeta().custom_metadata_map
+    if 'names' not in metadata:
+        raise ValueError('Model has no class names, export it with the bboxee, YOLOv5 or Ultralytics export.')
+    names = ast.literal_eval(metadata['names'])
+    return dict(enumerate(names)) if isinstance(names, list) else names
+
+
+def to_yolov5_layout(pred, classes):
+    """Convert Ultralytics (YOLOv8 / YOLOv9) output, boxes and class scores
+    without objectness, to the YOLOv5 layout expected by the NMS."""
+    if pred.shape[1] != classes + 4:
+        return pred
+    pred = pred.transpose(0, 2, 1)
+    objectness = np.ones(pred.shape[:2] + (1,), dtype=pred.dtype)
+    return np.concatenate((pred[..., :4], objectness, pred[..., 4:]), axis=2)
+
+
+def export(model_file, output_file=None, image_size=640, opset=12):
+    """Export a YOLOv5 .pt checkpoint to .onnx with dynamic batch and
+    image dimensions, class names are stored in the model metadata."""
+    import onnx
+    from yolov5.models.yolo import Detect
+    if output_file is None:
+        output_file = os.path.splitext(model_file)[0] + '.onnx'
+    model = load_model(model_file, 'cpu')
+    for m in model.modules():
+        if isinstance(m, Detect):
+            m.inplace = False
+            m.dynamic = True
+            m.export = True
+    stride = int(max(model.stride))
+    sample = torch.zeros(1, 3, image_size, image_size)
+    model(sample)  # dry run to build the anchor grids
+    torch.onnx.export(model, sample, output_file,
+                      opset_version=opset,
+                      do_constant_folding=True,
+                      input_names=['images'],
+                      output_names=['output0'],
+                      dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},
+                                    'output0': {0: 'batch', 1: 'anchors'}})
+    model_onnx = onnx.load(output_file)
+    for key, value in {'stride': stride, 'names': model.names}.items():
+        meta = model_onnx.metadata_props.add()
+        meta.key, meta.value = key, str(value)
+    onnx.save(model_onnx, output_file)
+    return output_file
+
+
+def fp32_file(model_file, family='yolov5', image_size=640):
+    """Return the FP32 ONNX model for a checkpoint, exporting it next to the
+    checkpoint when it is missing or older than the checkpoint."""
+    if model_file.endswith('.onnx'):
+        return model_file
+    output_file = os.path.splitext(model_file)[0] + '.onnx'
+    if not os.path.exists(output_file) or os.path.getmtime(output_file) < os.path.getmtime(model_file):
+        if family == 'yolov9':
+            from ultralytics import YOLO
+            output_file = YOLO(model_file).export(format='onnx', dynamic=True, imgsz=image_size)
+        else:
+            export(model_file, output_file, image_size)
+    return output_file
+
+
+def sample(files, count=32):
+    """Pick up to count files spread evenly over the list."""
+    if len(files) <= count:
+        return list(files)
+    step = len(files) / count
+    return [files[int(index * step)] for index in range(count)]
+
+
+class CalibrationReader(CalibrationDataReader):
+    """Feed letterboxed images to the static quantization calibrator."""
+
+    def __init__(self, input_name, files, load):
+        self.input_name = input_name
+        self.files = iter(files)
+        self.load = load
+
+    def get_next(self):
+        for file_name in self.files:
+            prepared = self.load(file_name)
+            if prepared is not None:
+                return {self.input_name: prepared[1][np.newaxis].astype(np.float32) / 255}
+        return None
+
+
+def quantize(model_file, mode, files, load, family='yolov5', image_size=640):
+    """Return an INT8 copy of a checkpoint or ONNX model.
+
+    The quantized model and its agreement report are cached next to the
+    model file and reused until the model changes. files are the
+    calibration images, load is the function that letterboxes them.
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown quantization mode: {}'.format(mode))
+    source = fp32_file(model_file, family, image_size)
+    output_file = '{}.int8-{}.onnx'.format(os.path.splitext(model_file)[0], mode)
+    report_file = os.path.splitext(output_file)[0] + '.json'
+    if os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(source):
+        if os.path.exists(report_file):
+            with open(report_file, 'r') as file:
+                print(format_report(json.load(file)))
+        return output_file
+    if mode == 'static':
+        input_name = load_session(source).get_inputs()[0].name
+        reader = CalibrationReader(input_name, files, load)
+        quantize_static(source, output_file, reader,
+                        quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8)
+    else:
+        quantize_dynamic(source, output_file, weight_type=QuantType.QUInt8)
+    report = agreement(source, output_file, files, load)
+    report['mode'] = mode
+    with open(report_file, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(format_report(report))
+    return output_file
+
+
+def detect(session, image, classes, conf_thres):
+    """Run one image through a session, returns the detections after NMS."""
+    pred = session.run(None, {session.get_inputs()[0].name: image})[0]
+    pred = to_yolov5_layout(pred, classes)
+    return non_max_suppression(torch.from_numpy(pred), conf_thres=conf_thres)[0]
+
+
+def agreement(fp32_model, int8_model, files, load, conf_thres=0.25, iou_thres=0.5):
+    """Compare the INT8 detections with the FP32 detections on the
+    calibration images. Each FP32 box is matched to the INT8 box it
+    overlaps most, a match needs an IoU of at least iou_thres."""
+    reference = load_session(fp32_model)
+    candidate = load_session(int8_model)
+    classes = len(load_names(reference))
+    report = {'images': 0,
+              'fp32_boxes': 0,
+              'int8_boxes': 0,
+              'matched': 0,
+              'same_label': 0,
+              'mean_iou': 0.0,
+              'iou_threshold': iou_thres,
+              'fp32_seconds': 0.0,
+              'int8_seconds': 0.0}
+    ious = []
+    for file_name in files:
+        prepared = load(file_name)
+        if prepared is None:
+            continue
+        image = prepared[1][np.newaxis].astype(np.float32) / 255
+        start = time.perf_counter()
+        expected = detect(reference, image, classes, conf_thres)
+        report['fp32_seconds'] += time.perf_counter() - start
+        start = time.perf_counter()
+        found = detect(candidate, image, classes, conf_thres)
+        report['int8_seconds'] += time.perf_counter() - start
+        report['images'] += 1
+        report['fp32_boxes'] += len(expected)
+        report['int8_boxes'] += len(found)
+        if len(expected) and len(found):
+            best, index = box_iou(expected[:, :4], found[:, :4]).max(1)
+            matched = best >= iou_thres
+            report['matched'] += int(matched.sum())
+            report['same_label'] += int((expected[matched, 5] == found[index[matched], 5]).sum())
+            ious += best[matched].tolist()
+    report['mean_iou'] = float(np.mean(ious)) if ious else 0.0
+    return report
+
+
+def format_report(report):
+    """One line summary of an agreement report."""
+    matched = report['matched'] / max(report['fp32_boxes'], 1)
+    same_label = report['same_label'] / max(report['matched'], 1)
+    speedup = report['fp32_seconds'] / report['int8_seconds'] if report['int8_seconds'] > 0 else 0.0
+    message = 'INT8 {} agreement on {} images: {} of {} FP32 boxes matched at IoU >= {} ({:.1%}), mean IoU {:.3f}, '
+    message += 'same label on {:.1%} of matches, {} INT8 boxes, {:.2f}x faster'
+    return message.format(report.get('mode', ''), report['images'], report['matched'], report['fp32_boxes'],
+                          report['iou_threshold'], matched, report['mean_iou'], same_label, report['int8_boxes'], speedup)
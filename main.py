@@ -24,12 +24,17 @@
 # --------------------------------------------------------------------------
 import os
 import sys
-from PyQt6 import QtWidgets, QtCore
-
-from bboxee.gui import MainWindow, DarkModePalette
-from bboxee import ExceptionHandler
+import multiprocessing
 
 if __name__ == "__main__":
+    # Image decoding processes re-import this module, only the main process
+    # imports Qt and the gui. In a frozen build, freeze_support runs the
+    # decoding process instead of starting the application again.
+    multiprocessing.freeze_support()
+    from PyQt6 import QtWidgets, QtCore
+    from bboxee.gui import MainWindow, DarkModePalette
+    from bboxee import ExceptionHandler  # noqa: F401
+
     app = QtWidgets.QApplication(sys.argv)
 
     app.setStyle('fusion')